@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/bench_backpressure.py
+    The memory of proxy/proxy.py under slow consumers: a server sends as
+    fast as it can down every connection, through a forwarder limited to
+    max_connections, to more clients than that, each reading a little at
+    a time. The forwarder's resident memory is sampled throughout, and
+    must stay flat (within SLACK_MB of its size once loaded), with no more
+    than max_connections forwarded at once. Exits non-zero otherwise.
+
+    usage: bench_backpressure.py [seconds [clients [max_connections]]]
+"""
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import tempfile
+import multiprocessing
+import SocketServer
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'proxy'))
+
+from proxy import TCPForwarder
+
+# growth allowed after warm up, for the interpreter's own allocations
+SLACK_MB = 4.0
+
+class FirehoseHandler(SocketServer.BaseRequestHandler):
+    chunk = 'x' * 65536
+
+    def handle(self):
+        try:
+            while True:
+                self.request.sendall(self.chunk)
+        except socket.error:
+            pass
+
+class FirehoseServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(server):
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    return process
+
+def rss_mb(pid):
+    """ Returns the resident memory of process pid, in MB. """
+    fileobj = open('/proc/%d/status' % pid)
+    try:
+        for line in fileobj:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024.0
+    finally:
+        fileobj.close()
+
+def stats(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        chunks = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    return json.loads(''.join(chunks))
+
+def slow_clients(address, count):
+    """ Returns count connections, each with a small receive buffer. """
+    clients = []
+    for i in xrange(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.connect(address)
+        sock.setblocking(0)
+        clients.append(sock)
+    return clients
+
+def nibble(clients, size=1024):
+    """ Reads up to size bytes from each client, returning the total. """
+    total = 0
+    for sock in clients:
+        try:
+            total += len(sock.recv(size))
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+    return total
+
+def main(seconds=10.0, clients=300, max_connections=200):
+    path = os.path.join(tempfile.mkdtemp(), 'stats')
+    firehose = FirehoseServer(('127.0.0.1', 0), FirehoseHandler)
+    forwarder = TCPForwarder(('127.0.0.1', 0), firehose.server_address,
+                             buffers=2 * max_connections,
+                             max_connections=max_connections, stats=path)
+    processes = [serve(firehose), serve(forwarder)]
+    pid = processes[1].pid
+    time.sleep(0.2)
+    try:
+        idle = rss_mb(pid)
+        sockets = slow_clients(forwarder.address, clients)
+        samples, received = [], 0
+        start = time.time()
+        while time.time() - start < seconds:
+            received += nibble(sockets)
+            time.sleep(0.05)
+            if not samples or time.time() - samples[-1][0] - start >= 0.5:
+                current = stats(path)
+                samples.append((time.time() - start, rss_mb(pid),
+                                current['active'], current['throttled']))
+        for sock in sockets:
+            sock.close()
+    finally:
+        for process in processes:
+            process.terminate()
+        os.unlink(path)
+        os.rmdir(os.path.dirname(path))
+
+    print '%8s %10s %8s %10s' % ('seconds', 'rss MB', 'active', 'throttled')
+    for sample in samples:
+        print '%8.1f %10.1f %8d %10d' % sample
+    # the first second is the connections being made
+    loaded = [sample for sample in samples if sample[0] >= 1.0]
+    baseline = loaded[0][1]
+    peak = max(sample[1] for sample in loaded)
+    most = max(sample[2] for sample in samples)
+    print 'idle %.1fMB, loaded %.1fMB, peak %.1fMB, received %.1fMB' % (
+            idle, baseline, peak, received / 2.0**20
+    )
+    failed = peak - baseline > SLACK_MB or most > max_connections
+    print failed and 'FAILED' or 'ok'
+    return samples, failed
+
+if __name__ == '__main__':
+    args = sys.argv[1:4]
+    kwargs = dict(zip(('seconds', 'clients', 'max_connections'),
+                      [float(args[0])] + map(int, args[1:]) if args else []))
+    samples, failed = main(**kwargs)
+    sys.exit(failed and 1 or 0)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/bench_perfdata.py
+    Throughput of nagios/perfdata.py reading a generated perfdata file,
+    against a naive parser splitting each line on whitespace, '=' and ';'
+    and matching the value with a regex.
+"""
+import os
+import re
+import sys
+import time
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nagios'))
+
+from plugin import NagiosPerformance
+from perfdata import iter_file
+
+NAIVE_VALUE = re.compile(r'^([-+.0-9eE]+|U)(.*)$')
+
+def naive(path):
+    """ The obvious parser, for comparison (ignores quoted labels). """
+    for line in open(path):
+        for item in line.split('|', 1)[-1].split():
+            label, data = item.split('=', 1)
+            fields = (data.split(';') + [''] * 4)[:5]
+            value, uom = NAIVE_VALUE.match(fields[0]).groups()
+            yield (label.strip("'"), value != 'U' and float(value) or None,
+                   uom, fields[1], fields[2], fields[3], fields[4])
+
+def write_spool(path, lines, labels_per_line):
+    spool = open(path, 'w')
+    for i in range(lines):
+        perf = NagiosPerformance()
+        for j in range(labels_per_line):
+            perf.add_label('metric_%d' % j, i * j * 0.5, 'ms', '80', '90',
+                           0, 100)
+        spool.write('service%d OK: fine%s\n' % (i, perf))
+    spool.close()
+
+def rate(parser, path, repeat=3):
+    """ Returns the best of repeat runs, as (labels, seconds, labels/s). """
+    runs = []
+    for i in range(repeat):
+        start, count = time.time(), 0
+        for label in parser(path):
+            count += 1
+        runs.append(time.time() - start)
+    elapsed = min(runs)
+    return count, elapsed, count / elapsed
+
+def main(lines=100000, labels_per_line=10):
+    fd, path = tempfile.mkstemp(suffix='.perfdata')
+    os.close(fd)
+    try:
+        write_spool(path, lines, labels_per_line)
+        size = os.path.getsize(path) / 1024.0 / 1024.0
+        print '%d labels, %0.1fMB' % (lines * labels_per_line, size)
+        results = {}
+        for name, parser in (('naive', naive), ('perfdata', iter_file)):
+            count, elapsed, per_second = rate(parser, path)
+            results[name] = per_second
+            print '%-10s %8.3fs %12.0f labels/s %8.1f MB/s' % (
+                    name, elapsed, per_second, size / elapsed
+            )
+        print 'speedup: %0.2fx' % (results['perfdata'] / results['naive'])
+        return results
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/bench_proxy.py
+    Connection rate and throughput of proxy/proxy.py, forwarding to a
+    local echo server, against connecting to the echo server directly, and
+    through a forwarder with a pool of ready connections (pooled), and one
+    which splices rather than copies (spliced). The echo server and the
+    forwarders each run in a process of their own; the CPU time each
+    forwarder spends relaying is reported per GB (from /proc).
+
+    Then, with as many clients as processors (each in a process), the
+    aggregate rates of one forwarder against a Supervisor of as many
+    workers (workers), which should scale with the processors available.
+"""
+import os
+import sys
+import time
+import socket
+import threading
+import multiprocessing
+import SocketServer
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'proxy'))
+
+from proxy import TCPForwarder, Supervisor, splice_available
+
+class EchoHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        recv, send = self.request.recv, self.request.sendall
+        while True:
+            data = recv(65536)
+            if not data:
+                break
+            send(data)
+
+class EchoServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(server):
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    return process
+
+def cpu_seconds(process):
+    """ Returns the user and system CPU time of process, in seconds. """
+    fileobj = open('/proc/%d/stat' % process.pid)
+    try:
+        # utime and stime, fields 14 and 15, after the (command)
+        fields = fileobj.read().rsplit(')', 1)[1].split()
+    finally:
+        fileobj.close()
+    return (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf('SC_CLK_TCK'))
+
+def connection_rate(address, count):
+    """ Returns connections per second, each echoing one byte. """
+    start = time.time()
+    for i in xrange(count):
+        sock = socket.create_connection(address)
+        sock.sendall('x')
+        sock.recv(1)
+        sock.close()
+    return count / (time.time() - start)
+
+def throughput(address, megabytes):
+    """ Returns MB/s echoed through one connection (each way). """
+    chunk = 'x' * (1024 * 1024)
+    sock = socket.create_connection(address)
+    def send():
+        for i in xrange(megabytes):
+            sock.sendall(chunk)
+        sock.shutdown(socket.SHUT_WR)
+    start = time.time()
+    sender = threading.Thread(target=send)
+    sender.start()
+    received = 0
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    sender.join()
+    sock.close()
+    assert received == megabytes * len(chunk)
+    return megabytes / (time.time() - start)
+
+def _client(args):
+    func, address, amount = args
+    func(address, amount)
+
+def parallel(func, address, amount, clients):
+    """
+    Returns the aggregate rate of clients processes, running func(address,
+    amount / clients) at once.
+    """
+    pool = multiprocessing.Pool(clients)
+    try:
+        start = time.time()
+        pool.map(_client, [(func, address, amount // clients)] * clients)
+        return amount / (time.time() - start)
+    finally:
+        pool.close()
+        pool.join()
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()
+    finally:
+        sock.close()
+
+def scaling(echo, connections, megabytes, clients):
+    """ Returns (connections/s, MB/s) of clients, for proxy and workers. """
+    address = free_port()
+    single = TCPForwarder(('127.0.0.1', 0), echo.server_address)
+    supervisor = Supervisor(lambda: TCPForwarder(address, echo.server_address,
+                                                 reuse_port=True),
+                            workers=clients, drain_timeout=1)
+    processes = [serve(single)]
+    processes.append(multiprocessing.Process(target=supervisor.serve_forever))
+    processes[-1].start()
+    time.sleep(0.5)
+    try:
+        results = {}
+        for name, target in (('proxy', single.address), ('workers', address)):
+            results[name] = (
+                    parallel(connection_rate, target, connections, clients),
+                    parallel(throughput, target, megabytes, clients),
+            )
+        return results
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+def main(connections=2000, megabytes=256):
+    echo = EchoServer(('127.0.0.1', 0), EchoHandler)
+    forwarder = TCPForwarder(('127.0.0.1', 0), echo.server_address)
+    pooled = TCPForwarder(('127.0.0.1', 0), echo.server_address,
+                          upstreams=dict(min_size=64, max_size=128))
+    spliced = TCPForwarder(('127.0.0.1', 0), echo.server_address,
+                           buffer_size=1024 * 1024, splice=True)
+    processes = [serve(echo)]
+    targets = [('direct', echo.server_address, None)]
+    for name, server in (('proxy', forwarder), ('pooled', pooled),
+                         ('spliced', spliced)):
+        if name == 'spliced' and not splice_available():
+            continue
+        processes.append(serve(server))
+        targets.append((name, server.address, processes[-1]))
+    time.sleep(0.2)
+    try:
+        results = {}
+        for name, address, process in targets:
+            rate = connection_rate(address, connections)
+            # echoed, so the forwarder relays the data twice
+            before = process and cpu_seconds(process)
+            mbps = throughput(address, megabytes)
+            per_gb = process and (cpu_seconds(process) - before) / \
+                    (2 * megabytes / 1024.0)
+            results[name] = (rate, mbps, per_gb)
+        print '%-8s %14s %10s %12s' % ('', 'connections/s', 'MB/s',
+                                       'CPU s/GB')
+        for name, address, process in targets:
+            rate, mbps, per_gb = results[name]
+            print '%-8s %14.0f %10.1f %12s' % (name, rate, mbps,
+                    per_gb is None and '-' or '%.2f' % per_gb)
+
+        clients = max(2, multiprocessing.cpu_count())
+        results['scaling'] = scaling(echo, connections, megabytes, clients)
+        print '\n%d clients' % clients
+        for name in ('proxy', 'workers'):
+            print '%-8s %14.0f %10.1f' % ((name,) + results['scaling'][name])
+        return results
+    finally:
+        for process in processes:
+            process.terminate()
+
+if __name__ == '__main__':
+    main()
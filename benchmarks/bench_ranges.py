@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/bench_ranges.py
+    Microbenchmark of NagiosRange construction (with the compiled range
+    cache, and without) and evaluation (compiled comparison, against the
+    original branch chain, reproduced below as legacy_check_range). Checks
+    are timed through functools.partial, so that no Python level wrapper
+    is counted on either side. Exits non-zero if a compiled check is
+    slower than the legacy one.
+"""
+import os
+import sys
+import timeit
+from functools import partial
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'nagios'))
+
+from plugin import NagiosRange, NagiosRangeCache
+
+DEFINITIONS = ['10', '10:', '~:10', '10:20', '@10:20']
+
+def legacy_check_range(self, value):
+    """ NagiosRange.check_range, before ranges were compiled. """
+    if type(value) not in (int, long, float):
+        raise ValueError("Value '%s' is not a number." % value)
+
+    if self.range is None:
+        return False
+
+    if not self.start_infinity and not self.end_infinity:
+        if self.start <= value <= self.end:
+            inrange = True
+        else:
+            inrange = False
+    elif not self.start_infinity and self.end_infinity:
+        if self.start <= value:
+            inrange = True
+        else:
+            inrange = False
+    elif self.start_infinity and not self.end_infinity:
+        if value <= self.end:
+            inrange = True
+        else:
+            inrange = False
+
+    if self.inside:
+        return inrange
+    else:
+        return not inrange
+
+def best(func, number):
+    """ Returns the best of 5 runs of func, in nanoseconds per call. """
+    return min(timeit.Timer(func).repeat(5, number)) / number * 1e9
+
+def construct():
+    for definition in DEFINITIONS:
+        NagiosRange(definition)
+
+def main(number=100000):
+    results = []
+    cache = NagiosRange.cache
+
+    NagiosRange.cache = NagiosRangeCache(maxsize=0)
+    uncached = best(construct, number // 10)
+    NagiosRange.cache = cache
+    cached = best(construct, number // 10)
+    results.append(('construct (per %d)' % len(DEFINITIONS),
+                    uncached, cached))
+
+    for definition in DEFINITIONS:
+        rnge = NagiosRange(definition)
+        legacy = best(partial(legacy_check_range, rnge, 15.0), number)
+        compiled = best(partial(rnge.check_range, 15.0), number)
+        results.append(('check_range %r' % definition, legacy, compiled))
+
+    print '%-28s %12s %12s %8s' % ('', 'before (ns)', 'after (ns)', 'speedup')
+    for name, before, after in results:
+        print '%-28s %12.0f %12.0f %7.2fx' % (name, before, after,
+                                              before / after)
+    print 'cache: %r' % NagiosRange.cache.info()
+    return results
+
+if __name__ == '__main__':
+    results = main()
+    slower = [name for name, before, after in results if after > before]
+    sys.exit(slower and 1 or 0)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/bench_startup.py
+    Start up time of the example plugins, from their first import to exit,
+    timed within the plugin's process -- the interpreter's own start up
+    varies too much between runs to subtract it. Results are saved as
+    JSON, as by suite.py, and compared with those of a baseline run (on
+    the same host) -- exiting 1 if any plugin slowed by more than the
+    threshold, so that a regression (say, a module level import of
+    logging) fails the build.
+
+    bench_startup.py [-n runs] [-o results.json]
+    bench_startup.py -b baseline.json [-t percent]
+"""
+import os
+import sys
+import optparse
+import subprocess
+
+from suite import compare, load, save
+
+EXAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                        'nagios', 'examples')
+
+PLUGINS = [
+    ('class_example', ['class_example.py', '-N', '5']),
+    ('factory_example', ['factory_example.py']),
+]
+
+# runs a plugin as __main__, writing the seconds it took to stderr
+TIMER = """
+import sys, time, runpy
+start = time.time()
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write('%r\\n' % (time.time() - start))
+"""
+
+def best(argv, runs):
+    """ Returns the fastest of runs runs of argv, in milliseconds. """
+    env = dict(os.environ)
+    # the first run writes .pyc files, as a first run in production would
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    devnull = open(os.devnull, 'w')
+    times = []
+    try:
+        for i in range(runs + 1):
+            p = subprocess.Popen([sys.executable, '-c', TIMER] + argv,
+                                 cwd=EXAMPLES, env=env, stdout=devnull,
+                                 stderr=subprocess.PIPE)
+            stderr = p.communicate()[1]
+            times.append(float(stderr.splitlines()[-1]) * 1000)
+    finally:
+        devnull.close()
+    return min(times[1:])
+
+def run(runs=20):
+    """ Returns a dict of plugin name -> milliseconds from import to exit. """
+    results = {}
+    for name, argv in PLUGINS:
+        results[name] = best(argv, runs)
+        print '%-20s %8.2fms' % (name, results[name])
+    return results
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=(
+            '%prog [-n runs] [-o results.json]\n'
+            '       %prog -b baseline.json [-t percent]'
+    ))
+    parser.add_option('-n', '--runs', dest='runs', type='int', default=20,
+                      help='runs of each plugin, the fastest counts')
+    parser.add_option('-o', '--output', dest='output',
+                      help='write results (JSON) to this file')
+    parser.add_option('-b', '--baseline', dest='baseline',
+                      help='compare with these results (JSON)')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=10.0, help='regression threshold (percent)')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ' '.join(args))
+
+    results = run(options.runs)
+    if options.output:
+        save(options.output, results)
+    if options.baseline:
+        baseline = load(options.baseline)
+        print 'baseline: %s' % baseline['commit']
+        regressions = compare(baseline['results'], results,
+                              options.threshold)
+        return regressions and 1 or 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
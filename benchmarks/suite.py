@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+benchmarks/suite.py
+    Times the plugin framework (ranges, thresholds, performance data),
+    utils/units, utils/paths and utils/io, and saves the results as JSON,
+    so that runs may be compared across commits.
+
+    suite.py run [-o results.json] [-k pattern]
+    suite.py compare before.json after.json [-t percent]
+
+    compare lists every benchmark found in both runs, flagging those which
+    slowed by more than the threshold (10% by default), and exits 1 if any
+    did.
+"""
+import os
+import sys
+import imp
+import json
+import time
+import timeit
+import fnmatch
+import optparse
+import platform
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..')
+sys.path.insert(0, os.path.join(ROOT, 'nagios'))
+
+from plugin import NagiosRange, NagiosRangeCache, NagiosPerformance, \
+        NagiosPlugin, camel_to_under
+
+# utils/io.py would shadow the standard io module, if utils were on the path
+units = imp.load_source('units', os.path.join(ROOT, 'utils', 'units.py'))
+paths = imp.load_source('paths', os.path.join(ROOT, 'utils', 'paths.py'))
+
+# name -> function returning (callable, operations per call)
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(setup):
+        BENCHMARKS.append((name, setup))
+        return setup
+    return register
+
+def measure(func, repeat=5, minimum=0.1):
+    """
+    Returns the best time of func, in seconds per call, over repeat runs of
+    enough calls to take at least minimum seconds.
+    """
+    timer, number = timeit.Timer(func), 1
+    while timer.timeit(number) < minimum:
+        number *= 2
+    return min(timer.repeat(repeat, number)) / number
+
+@benchmark('range_parse_uncached')
+def range_parse_uncached():
+    cache = NagiosRangeCache(maxsize=0)
+    def run():
+        NagiosRange.cache, saved = cache, NagiosRange.cache
+        try:
+            NagiosRange('@10:20')
+        finally:
+            NagiosRange.cache = saved
+    return run, 1
+
+@benchmark('range_parse_cached')
+def range_parse_cached():
+    return (lambda: NagiosRange('@10:20')), 1
+
+@benchmark('check_range')
+def check_range():
+    rnge = NagiosRange('10:20')
+    return (lambda: rnge.check_range(15.0)), 1
+
+@benchmark('check_thresholds')
+def check_thresholds():
+    plugin = NagiosPlugin(args=['-w', '10', '-c', '20'], standalone=False)
+    return (lambda: plugin.check_thresholds(15.0)), 1
+
+def _labels(count):
+    perf = NagiosPerformance()
+    for i in xrange(count):
+        perf.add_label('label_%d' % i, i * 0.5, 'ms', '80', '90', 0, 100)
+    return perf
+
+for _count in (10, 1000, 100000):
+    @benchmark('add_label_%d' % _count)
+    def add_label(count=_count):
+        return (lambda: _labels(count)), count
+
+    @benchmark('format_performance_%d' % _count)
+    def format_performance(count=_count):
+        perf = _labels(count)
+        return perf.format_performance, count
+
+@benchmark('camel_to_under')
+def camel_to_under_():
+    return (lambda: camel_to_under('CheckDiskUsage2nd')), 1
+
+@benchmark('units_bytes_to_human')
+def units_bytes_to_human():
+    return (lambda: units.bytes_to_human(123456789)), 1
+
+@benchmark('units_bits_per_second')
+def units_bits_per_second():
+    return (lambda: units.bits_per_second(123456789, 60)), 1
+
+@benchmark('units_seconds_to_human')
+def units_seconds_to_human():
+    return (lambda: units.seconds_to_human(31536999)), 1
+
+@benchmark('paths_this')
+def paths_this():
+    return (lambda: paths.this(__file__)), 1
+
+@benchmark('io_stdin_8mb')
+def io_stdin():
+    # a separate interpreter reading 8MB from a pipe, per MB
+    data = ('x' * 79 + '\n') * (8 * 1024 * 1024 / 80)
+    argv = [sys.executable, '-c', 'import io; io.StdIn()']
+    def run():
+        p = subprocess.Popen(argv, cwd=os.path.join(ROOT, 'utils'),
+                             stdin=subprocess.PIPE)
+        p.communicate(data)
+    return run, 8
+
+@benchmark('io_stdin_stream_8mb')
+def io_stdin_stream():
+    # as io_stdin_8mb, by line through StdInStream, per MB
+    data = ('x' * 79 + '\n') * (8 * 1024 * 1024 / 80)
+    argv = [sys.executable, '-c',
+            'import io\nfor line in io.StdInStream(): pass']
+    def run():
+        p = subprocess.Popen(argv, cwd=os.path.join(ROOT, 'utils'),
+                             stdin=subprocess.PIPE)
+        p.communicate(data)
+    return run, 8
+
+def run(pattern='*'):
+    """ Returns a dict of benchmark name -> nanoseconds per operation. """
+    results = {}
+    for name, setup in BENCHMARKS:
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        func, operations = setup()
+        results[name] = measure(func) / operations * 1e9
+        print '%-28s %14.1f ns/op' % (name, results[name])
+    return results
+
+def commit():
+    """ Returns the current git commit, or None. """
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=ROOT, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out = p.communicate()[0].strip()
+    except OSError:
+        return None
+    return out or None
+
+def compare(before, after, threshold=10.0):
+    """
+    Prints the change in each benchmark found in both result sets, and
+    returns the names of those slower by more than threshold percent.
+    """
+    regressions = []
+    print '%-28s %12s %12s %8s' % ('', 'before', 'after', 'change')
+    for name in sorted(set(before) & set(after)):
+        change = (after[name] / before[name] - 1) * 100
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        print '%-28s %12.1f %12.1f %+7.1f%% %s' % (
+                name, before[name], after[name], change, flag
+        )
+    return regressions
+
+def load(path):
+    fileobj = open(path)
+    try:
+        return json.load(fileobj)
+    finally:
+        fileobj.close()
+
+def save(path, results):
+    """ Writes results to path as JSON, with the commit and python version. """
+    fileobj = open(path, 'w')
+    try:
+        json.dump({
+            'commit': commit(),
+            'python': platform.python_version(),
+            'time': time.time(),
+            'results': results,
+        }, fileobj, indent=1, sort_keys=True)
+    finally:
+        fileobj.close()
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage=(
+            '%prog run [-o results.json] [-k pattern]\n'
+            '       %prog compare before.json after.json [-t percent]'
+    ))
+    parser.add_option('-o', '--output', dest='output',
+                      help='write results (JSON) to this file')
+    parser.add_option('-k', dest='pattern', default='*',
+                      help='run only benchmarks matching this glob')
+    parser.add_option('-t', '--threshold', dest='threshold', type='float',
+                      default=10.0, help='regression threshold (percent)')
+    options, args = parser.parse_args(argv)
+
+    if args[:1] == ['run']:
+        results = run(options.pattern)
+        if options.output:
+            save(options.output, results)
+        return 0
+    elif args[:1] == ['compare'] and len(args) == 3:
+        before, after = load(args[1]), load(args[2])
+        print 'before: %s, after: %s' % (before['commit'], after['commit'])
+        regressions = compare(before['results'], after['results'],
+                              options.threshold)
+        return regressions and 1 or 0
+    parser.error('expected run, or compare with two result files')
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import traceback
+
+# trollius is the python 2 port of asyncio (PEP 3156), coroutines are
+# generators decorated with @asyncio.coroutine, awaiting with yield From(...)
+import trollius as asyncio
+from trollius import From, Return
+
+from plugin import NagiosPlugin, NagiosPluginFactory, NagiosPluginExit, \
+        NagiosTimeout, UnhandledExceptionHandler, CRIT, UNKN
+from batch import NagiosResult
+
+"""
+nagios/aio.py Martin Walsh <sysadm@mwalsh.org>
+    Event loop driven nagios plugins, for checks which spend most of their
+    time waiting on the network. The check method is a coroutine, and the
+    timeout is enforced by the event loop, rather than SIGALRM, so that
+    hundreds of checks can run concurrently in a single process.
+
+    class CheckPort(AsyncNagiosPlugin):
+        @asyncio.coroutine
+        def check(self):
+            reader, writer = yield From(asyncio.open_connection(
+                    self.options.hostname, 80
+            ))
+            writer.close()
+            self.die(OK, 'Port 80 is open')
+
+    CheckPort().run()
+"""
+
+__all__ = [
+    'AsyncNagiosPlugin', 'AsyncNagiosPluginFactory', 'run_check', 'run_all',
+]
+
+class _Died(Exception):
+    """
+    NagiosPluginExit is a SystemExit, which the event loop does not trap,
+    so die wraps it in this exception while in a coroutine.
+    """
+    def __init__(self, exit):
+        Exception.__init__(self, exit.output)
+        self.exit = exit
+
+def _exit(instance, code, info, cancel_alarm=True):
+    """ Returns, rather than raises, the NagiosPluginExit of instance.die """
+    try:
+        instance.die(code, info, cancel_alarm)
+    except _Died, e:
+        return e.exit
+
+@asyncio.coroutine
+def run_check(instance, *args, **kwargs):
+    """
+    A coroutine which runs the check coroutine of instance (with args and
+    kwargs) until it dies or its deadline passes. All exceptions are handled
+    as by UnhandledExceptionHandler.
+
+    @param instance: an AsyncNagiosPlugin or AsyncNagiosPluginFactory
+    @return: NagiosPluginExit, as raised by die (None if the check returned
+             without calling die)
+    """
+    try:
+        yield From(asyncio.wait_for(
+                instance.check(*args, **kwargs), instance.deadline.remaining()
+        ))
+    except _Died, e:
+        exit = e.exit
+    except (asyncio.TimeoutError, NagiosTimeout):
+        exit = _exit(instance, CRIT, instance.deadline.message, False)
+    except Exception:
+        exit = _exit(instance, UNKN,
+                     UnhandledExceptionHandler._fmt % traceback.format_exc())
+    else:
+        exit = None
+    raise Return(exit)
+
+class _AsyncRunner(object):
+    def run(self, loop=None):
+        """
+        Runs the check to completion on loop (by default, the current event
+        loop), and exits (raising NagiosPluginExit) as die does.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        exit = loop.run_until_complete(run_check(self))
+        if exit is not None:
+            raise exit
+
+class AsyncNagiosPlugin(_AsyncRunner, NagiosPlugin):
+    """
+    Base class for nagios plugins whose check method is a coroutine. Output
+    and performance data are as for NagiosPlugin, but the timeout (-t) is
+    enforced by the event loop, in place of SIGALRM and the default socket
+    timeout. Use run to run the check from a script, or run_all to run many
+    concurrently.
+    """
+    def _set_timeout(self, network):
+        # see run_check
+        pass
+
+    def die(self, code, info, cancel_alarm=True):
+        try:
+            NagiosPlugin.die(self, code, info, cancel_alarm)
+        except NagiosPluginExit, e:
+            raise _Died(e)
+    die.__doc__ = NagiosPlugin.die.__doc__
+
+    @asyncio.coroutine
+    def check(self):
+        """
+        Override this coroutine in your subclass, as for NagiosPlugin.check.
+        """
+        raise NotImplementedError(
+            "Subclasses of 'AsyncNagiosPlugin' must override the 'check' "
+            "method."
+        )
+
+class AsyncNagiosPluginFactory(_AsyncRunner, NagiosPluginFactory):
+    """
+    As NagiosPluginFactory, but check_function is a coroutine function which
+    should return a sequence of (value, message) pair(s).
+    """
+    plugin_class = AsyncNagiosPlugin
+
+    @asyncio.coroutine
+    def check(self, perf_labels=None, *args, **kwargs):
+        responses = yield From(self.plugin.check(*args, **kwargs))
+        self.respond(responses, perf_labels)
+
+@asyncio.coroutine
+def _run_job(plugin, args, kwargs, semaphore):
+    if semaphore is not None:
+        yield From(semaphore.acquire())
+    start = time.time()
+    try:
+        try:
+            instance = plugin(args=list(args), standalone=False,
+                              **(kwargs or {}))
+        except NagiosPluginExit, e:
+            # eg. the version option
+            exit = e
+        except SystemExit, e:
+            info = 'Plugin exited (%s) without calling die.' % e.code
+            raise Return(NagiosResult(UNKN, info, None, 0.0, info))
+        except Exception:
+            # eg. a bad option type, as nagios/batch.py run_job reports it
+            info = 'Unhandled exception in check\n%s' % traceback.format_exc()
+            raise Return(NagiosResult(UNKN, info, None, 0.0, info))
+        else:
+            exit = yield From(run_check(instance))
+    finally:
+        if semaphore is not None:
+            semaphore.release()
+
+    if exit is None:
+        info = 'Check returned without calling die.'
+        raise Return(NagiosResult(UNKN, info, None, time.time() - start, info))
+    raise Return(NagiosResult.from_exit(exit, time.time() - start))
+
+def run_all(jobs, limit=None, loop=None):
+    """
+    Runs jobs concurrently on a single event loop, returning a list of
+    NagiosResult in the same order as jobs. Jobs are (plugin, args) or
+    (plugin, args, kwargs) tuples, as for nagios/batch.py, where plugin is
+    an AsyncNagiosPlugin subclass, or a callable returning an instance of
+    one (or an AsyncNagiosPluginFactory).
+
+    @param jobs:  a sequence of job tuples
+    @param limit: the maximum number of checks to run at once (optional),
+                  each check's deadline starts when the check does
+    @param loop:  the event loop (by default, the current event loop)
+    @return: list, of NagiosResult
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if limit:
+        semaphore = asyncio.Semaphore(limit, loop=loop)
+    else:
+        semaphore = None
+
+    tasks = []
+    for job in jobs:
+        plugin, args, kwargs = (tuple(job) + (None,))[:3]
+        tasks.append(_run_job(plugin, args, kwargs, semaphore))
+    return loop.run_until_complete(asyncio.gather(*tasks, loop=loop))
@@ -0,0 +1,225 @@
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import time
+import signal
+import threading
+import traceback
+import collections
+import multiprocessing
+
+from plugin import NagiosPluginExit, CRIT, UNKN
+
+"""
+nagios/batch.py Martin Walsh <sysadm@mwalsh.org>
+    Runs many plugin checks concurrently, in one interpreter, on a bounded
+    pool of threads or processes, collecting a structured result for each
+    in place of the usual status line and exit code.
+"""
+
+__all__ = ['NagiosResult', 'run_job', 'run_batch']
+
+class NagiosResult(object):
+    """
+    The outcome of a single check run by run_job or run_batch.
+
+    >>> result = NagiosResult(1, 'Value is 15', None, 0.5, 'x WARNING: ...')
+    >>> result.code, result.info, result.runtime
+    (1, 'Value is 15', 0.5)
+    >>> result.perfdata
+    ''
+    """
+    def __init__(self, code, info, performance=None, runtime=0.0, output=''):
+        """
+        @param code:        the exit code (one of OK, WARN, CRIT, or UNKN)
+        @param info:        the info message, as passed to die
+        @param performance: the NagiosPerformance collected by the check
+        @param runtime:     the wall clock time taken by the check, in seconds
+        @param output:      the complete status line
+        """
+        self.code = code
+        self.info = info
+        self.performance = performance
+        self.runtime = runtime
+        self.output = output
+
+    @classmethod
+    def from_exit(cls, exit, runtime=0.0):
+        """ Returns the NagiosResult of a NagiosPluginExit raised by die. """
+        return cls(exit.code, exit.info, exit.performance, runtime, exit.output)
+
+    @property
+    def perfdata(self):
+        """ The formatted performance data, or '' if there is none. """
+        if self.performance is None:
+            return ''
+        return self.performance.format_performance()
+
+    def __repr__(self):
+        return '<NagiosResult code=%s runtime=%0.3f %r>' % (
+                self.code, self.runtime, self.output
+        )
+
+def run_job(plugin, args=(), kwargs=None, alarm=False, started=None):
+    """
+    Runs a single check in the current thread, returning a NagiosResult. The
+    plugin is created with standalone=False, so it neither writes to stdout
+    nor touches process-wide state.
+
+    @param plugin:  a NagiosPlugin subclass, or any callable returning an
+                    object with a check method, called as plugin(args=args,
+                    standalone=False, **kwargs) -- for example, a partially
+                    applied NagiosPluginFactory
+    @param args:    the command line arguments for the check
+    @param kwargs:  additional keyword arguments for the plugin (optional)
+    @param alarm:   if True, the timeout (-t) is enforced with SIGALRM, which
+                    requires the main thread of a process (as in a process
+                    pool worker)
+    @param started: called with the plugin instance once the command line
+                    has been parsed, and the check is about to start
+    @return: NagiosResult
+    """
+    start = time.time()
+    if alarm: handler = signal.getsignal(signal.SIGALRM)
+    try:
+        try:
+            instance = plugin(args=list(args), standalone=False,
+                              **(kwargs or {}))
+            if alarm:
+                # as NagiosPlugin does when standalone
+                def timeout(signum, frame):
+                    instance.die(CRIT, instance.deadline.message,
+                                 cancel_alarm=False)
+                signal.signal(signal.SIGALRM, timeout)
+                signal.setitimer(
+                        signal.ITIMER_REAL, instance.deadline.remaining()
+                )
+            if started is not None: started(instance)
+            instance.check()
+        finally:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, handler)
+    except NagiosPluginExit, e:
+        return NagiosResult.from_exit(e, time.time() - start)
+    except SystemExit, e:
+        # eg. an optparse usage error
+        info = 'Plugin exited (%s) without calling die.' % e.code
+        return NagiosResult(UNKN, info, None, time.time() - start, info)
+    except Exception:
+        info = 'Unhandled exception in check\n%s' % traceback.format_exc()
+        return NagiosResult(UNKN, info, None, time.time() - start, info)
+    else:
+        info = 'Check returned without calling die.'
+        return NagiosResult(UNKN, info, None, time.time() - start, info)
+
+def _timed_out(instance, runtime):
+    """
+    Returns the NagiosResult of a check which has run out of time, with the
+    same output as a standalone plugin interrupted by SIGALRM.
+    """
+    try:
+        instance.die(CRIT, instance.deadline.message, cancel_alarm=False)
+    except NagiosPluginExit, e:
+        return NagiosResult.from_exit(e, runtime)
+
+def _process_job(job):
+    """ Runs a job in a process pool worker, where SIGALRM is available. """
+    return run_job(*job, alarm=True)
+
+def _normalize(job):
+    """ Accepts (plugin, args) or (plugin, args, kwargs) job tuples. """
+    if len(job) == 2:
+        return job[0], job[1], None
+    return tuple(job)
+
+def run_batch(jobs, workers=8, processes=False):
+    """
+    Runs jobs concurrently on a bounded pool, returning a list of
+    NagiosResult in the same order as jobs.
+
+    Each job is a (plugin, args) or (plugin, args, kwargs) tuple, as
+    described by run_job. For example,
+
+        run_batch([(CheckDisk, ['-w', '80', '/']),
+                   (CheckDisk, ['-w', '90', '/var'])], workers=4)
+
+    With processes=True the jobs run in a multiprocessing.Pool (so plugins,
+    their arguments and results must be picklable), and each check is
+    interrupted by SIGALRM when its timeout (-t) expires. Threads cannot be
+    interrupted, so in a thread pool a check which outlives its deadline is
+    reported as timed out, and its thread abandoned to finish in the
+    background, no longer counted against workers -- the remaining checks
+    start on fresh threads, so no check waits on another past its deadline.
+    Checks meant for thread pools should still bound blocking calls by their
+    deadline (see NagiosDeadline), as abandoned threads are not reclaimed.
+
+    @param jobs:      a sequence of job tuples
+    @param workers:   the maximum number of checks to run at once
+    @param processes: if True use a pool of processes, otherwise threads
+    @return: list, of NagiosResult
+    """
+    jobs = [_normalize(job) for job in jobs]
+    if processes:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = [pool.apply_async(_process_job, (job,)) for job in jobs]
+            return [result.get() for result in pending]
+        finally:
+            pool.terminate()
+
+    results = [None] * len(jobs)
+    # indices of the checks started, and not yet finished or abandoned
+    busy = set()
+    # index -> plugin instance, once its check has started
+    running = {}
+    pending = collections.deque(xrange(len(jobs)))
+    condition = threading.Condition()
+
+    def worker(i, job):
+        def started(instance):
+            with condition:
+                running[i] = instance
+                condition.notify()
+        result = run_job(*job, started=started)
+        with condition:
+            # a timed out check already has a result
+            if results[i] is None: results[i] = result
+            running.pop(i, None)
+            busy.discard(i)
+            condition.notify()
+
+    with condition:
+        while True:
+            now, wakeup = time.time(), None
+            for i, instance in running.items():
+                deadline = instance.deadline.end
+                if now >= deadline:
+                    results[i] = _timed_out(
+                            instance, instance.deadline.elapsed()
+                    )
+                    # abandon the thread, its worker goes to the next job
+                    del running[i]
+                    busy.discard(i)
+                elif wakeup is None or deadline < wakeup:
+                    wakeup = deadline
+            while pending and len(busy) < workers:
+                i = pending.popleft()
+                busy.add(i)
+                thread = threading.Thread(target=worker, args=(i, jobs[i]))
+                thread.daemon = True
+                thread.start()
+            if None not in results:
+                return results
+            condition.wait(wakeup and wakeup - now)
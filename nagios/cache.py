@@ -0,0 +1,269 @@
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import stat
+import time
+import errno
+import fcntl
+import hashlib
+import tempfile
+import cPickle as pickle
+from functools import wraps
+
+from plugin import NagiosPluginError
+
+"""
+nagios/cache.py Martin Walsh <sysadm@mwalsh.org>
+    A disk cache of collected data, shared by the checks which are views of
+    one expensive collection (an inventory, a status page). Results expire
+    after a ttl, the cache is bounded in size, and when many processes ask
+    for the same missing result at once only one collects it, while the
+    rest wait for it (single flight).
+
+    @memoize(ttl=60)
+    def inventory(host):
+        return fetch_inventory(host) # slow
+
+    class CheckDisks(NagiosPlugin):
+        def check(self):
+            disks = inventory(self.options.hostname)['disks']
+            ...
+"""
+
+__all__ = ['NagiosCache', 'memoize']
+
+class NagiosCache(object):
+    """
+    Pickled results on local disk, one file per key, with a lock file per
+    key for single flight collection.
+
+    >>> import shutil
+    >>> cache = NagiosCache(tempfile.mkdtemp(), ttl=60)
+    >>> calls = []
+    >>> def collect():
+    ...     calls.append(1)
+    ...     return {'disks': ['sda', 'sdb']}
+    >>> cache.get('inventory', collect)
+    {'disks': ['sda', 'sdb']}
+    >>> cache.get('inventory', collect), len(calls)
+    ({'disks': ['sda', 'sdb']}, 1)
+    >>> cache.get('inventory', collect, ttl=0) and len(calls)
+    2
+    >>> cache.clear(); [name[-5:] for name in os.listdir(cache.directory)]
+    ['.lock']
+    >>> shutil.rmtree(cache.directory)
+    """
+    def __init__(self, directory=None, ttl=60, maxsize=64 * 1024 * 1024):
+        """
+        @param directory: where results are kept (defaults to
+                          ~/.cache/nagios, for the nagios user eg.
+                          /var/lib/nagios/.cache/nagios), which must be a
+                          directory of the user's, with mode 0700
+        @param ttl:       the default time to live of a result, in seconds
+        @param maxsize:   the most disk space (in bytes) results may take,
+                          beyond which the oldest are evicted
+        """
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache',
+                                     'nagios')
+        try:
+            os.makedirs(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # results are pickles, which load as code -- a directory another
+        # user made (or can write to) could hold anything
+        st = os.lstat(directory)
+        if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or \
+                stat.S_IMODE(st.st_mode) & 077:
+            raise NagiosPluginError(
+                    'Refusing the cache directory %s, it must be a directory '
+                    'owned by uid %d with mode 0700.' % (directory,
+                                                         os.getuid())
+            )
+        self.directory = directory
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+    def _path(self, key):
+        return os.path.join(self.directory,
+                            hashlib.sha1(repr(key)).hexdigest())
+
+    def _load(self, path):
+        """ Returns (True, value) if path holds a fresh result. """
+        try:
+            fileobj = open(path, 'rb')
+        except IOError:
+            return False, None
+        try:
+            try:
+                expires, value = pickle.load(fileobj)
+            except Exception:
+                # torn or foreign, collect it again
+                return False, None
+        finally:
+            fileobj.close()
+        return expires > time.time(), value
+
+    def _store(self, path, value, ttl):
+        """ Writes value atomically (by rename), then evicts if need be. """
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.')
+        try:
+            fileobj = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump((time.time() + ttl, value), fileobj,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                fileobj.close()
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def _lock(self, path, deadline):
+        """
+        Returns a file descriptor holding the lock for path, waiting until
+        deadline (a NagiosDeadline, or None to wait indefinitely).
+        """
+        fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            if deadline is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                return fd
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                deadline.sleep(0.01)
+        except:
+            os.close(fd)
+            raise
+
+    def get(self, key, collect, ttl=None, deadline=None):
+        """
+        Returns the cached result for key, calling collect() (with no
+        arguments) if there is none, or it has expired. Of the processes
+        (or threads) which find the result missing at once, one collects it,
+        and the rest wait on its lock and read its result. Exceptions raised
+        by collect are not cached.
+
+        @param key:      any object with a stable repr, eg. a tuple of strings
+        @param collect:  returns the result, which must be picklable
+        @param ttl:      the time to live of a new result (defaults to the
+                         ttl of the cache)
+        @param deadline: a NagiosDeadline bounding the wait for another
+                         process's collection (raising NagiosTimeout)
+        """
+        if ttl is None:
+            ttl = self.ttl
+        path = self._path(key)
+        fresh, value = self._load(path)
+        if fresh and ttl > 0:
+            return value
+
+        fd = self._lock(path, deadline)
+        try:
+            # collected while we waited?
+            fresh, value = self._load(path)
+            if fresh and ttl > 0:
+                return value
+            value = collect()
+            self._store(path, value, ttl)
+            return value
+        finally:
+            os.close(fd)
+
+    def evict(self):
+        """
+        Removes the least recently written results until the cache fits
+        maxsize. Lock files are left, unlinking one which another process
+        is waiting on would let a second collection start.
+
+        @return: int, the number of results removed
+        """
+        entries, total = [], 0
+        for name in os.listdir(self.directory):
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+            total += stat.st_size
+        if total <= self.maxsize:
+            return 0
+
+        removed = 0
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.maxsize:
+                break
+            path = os.path.join(self.directory, name)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+            removed += 1
+        return removed
+
+    def clear(self):
+        """ Removes every result, leaving the lock files (see evict). """
+        for name in os.listdir(self.directory):
+            if name.startswith('.') or name.endswith('.lock'):
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+# the cache used by memoize, created on first use
+_DEFAULT = []
+
+def memoize(ttl=60, cache=None):
+    """
+    Decorates a collection function so that its results are cached (see
+    NagiosCache.get), keyed by its name and arguments, which should have
+    stable reprs (strings, numbers, and tuples of them).
+
+    >>> import shutil
+    >>> @memoize(ttl=60, cache=NagiosCache(tempfile.mkdtemp()))
+    ... def double(x):
+    ...     return x * 2
+    >>> double(21), double(21)
+    (42, 42)
+    >>> shutil.rmtree(double.cache.directory)
+
+    @param ttl:   the time to live of a result
+    @param cache: a NagiosCache (defaults to a cache shared by every
+                  memoized function, see NagiosCache)
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if wrapper.cache is None:
+                if not _DEFAULT: _DEFAULT.append(NagiosCache())
+                wrapper.cache = _DEFAULT[0]
+            key = (func.__module__, func.__name__, args,
+                   sorted(kwargs.items()))
+            return wrapper.cache.get(key, lambda: func(*args, **kwargs), ttl)
+        wrapper.cache = cache
+        return wrapper
+    return decorator
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import re
+import sys
+import shlex
+import signal
+import socket
+import struct
+import logging
+import binascii
+import optparse
+import traceback
+import StringIO
+import SocketServer
+
+from plugin import NagiosPluginError, UNKN
+
+"""
+nagios/nrpe.py Martin Walsh <sysadm@mwalsh.org>
+    A long-lived daemon which speaks the NRPE (version 2) request/response
+    protocol, and runs NagiosPlugin subclasses (or NagiosPluginFactory
+    instances) without paying for interpreter startup and imports on every
+    check. By default each request is handled in a fork of the (already
+    warm) daemon process, otherwise checks are run in place, one at a time.
+"""
+
+__all__ = [
+    'NRPEPacket', 'NRPEServer', 'ForkingNRPEServer', 'NRPEHandler',
+    'run_inplace', 'load_config',
+]
+
+DEFAULT_PORT = 5666
+DEFAULT_BIND = '127.0.0.1'
+# seconds to wait on a client, as nrpe's connection_timeout
+DEFAULT_CONNECTION_TIMEOUT = 300
+
+# packet constants from nrpe's common.h
+QUERY_PACKET = 1
+RESPONSE_PACKET = 2
+NRPE_PACKET_VERSION_2 = 2
+MAX_PACKETBUFFER_LENGTH = 1024
+
+# reserved command name, used by check_nrpe with no -c option
+NRPE_CHECK = '_NRPE_CHECK'
+NRPE_VERSION = 'NRPE v2.15 (sysadm nrpe)'
+
+ARG_MACRO = re.compile(r'\$ARG([0-9]+)\$')
+
+class NRPEPacket(object):
+    """
+    A single NRPE version 2 packet, laid out as the C struct in nrpe's
+    common.h (including the two trailing bytes of struct padding).
+
+    >>> data = NRPEPacket(QUERY_PACKET, 'check_load!1!2').pack()
+    >>> len(data) == NRPEPacket.size
+    True
+    >>> packet = NRPEPacket.unpack(data)
+    >>> packet.type == QUERY_PACKET, packet.buffer
+    (True, 'check_load!1!2')
+
+    >>> NRPEPacket.unpack(data[:10] + 'x' + data[11:])
+    Traceback (most recent call last):
+    ...
+    NagiosPluginError: NRPE packet failed crc32 check.
+    """
+    _struct = struct.Struct('!hhLh%ds2x' % MAX_PACKETBUFFER_LENGTH)
+    size = _struct.size
+
+    def __init__(self, type, buffer, result_code=UNKN,
+                 version=NRPE_PACKET_VERSION_2):
+        """
+        @param type:        QUERY_PACKET or RESPONSE_PACKET
+        @param buffer:      the command (query) or plugin output (response)
+        @param result_code: the plugin exit code (response only)
+        @param version:     the packet version, only version 2 is supported
+        """
+        self.type = type
+        self.buffer = buffer[:MAX_PACKETBUFFER_LENGTH - 1]
+        self.result_code = result_code
+        self.version = version
+
+    def pack(self):
+        """ Returns the on-the-wire representation of this packet. """
+        fields = [self.version, self.type, 0, self.result_code, self.buffer]
+        crc = binascii.crc32(self._struct.pack(*fields)) & 0xffffffff
+        fields[2] = crc
+        return self._struct.pack(*fields)
+
+    @classmethod
+    def unpack(cls, data):
+        """
+        Returns an NRPEPacket from its on-the-wire representation, raising
+        a NagiosPluginError if the data is short, or fails the crc check.
+        """
+        if len(data) != cls.size:
+            raise NagiosPluginError('NRPE packet has invalid length.')
+        version, type, crc, code, buffer = cls._struct.unpack(data)
+        # crc is calculated with the crc field zeroed, over all bytes sent
+        expected = binascii.crc32(data[:4] + '\0' * 4 + data[8:])
+        if crc != expected & 0xffffffff:
+            raise NagiosPluginError('NRPE packet failed crc32 check.')
+        if version != NRPE_PACKET_VERSION_2:
+            raise NagiosPluginError('NRPE packet version is not supported.')
+        return cls(type, buffer.split('\0', 1)[0], code, version)
+
+def run_inplace(plugin, args, **kwargs):
+    """
+    Runs a check in the current process and returns an (exit code, output)
+    pair, in place of exiting. The plugin's stdout (status line and verbose
+    logging), signal handler, and socket timeout are captured or restored,
+    so the process remains usable for the next check.
+
+    @param plugin: a NagiosPlugin subclass, or any callable returning an
+                   object with a check method, called as plugin(args=args,
+                   **kwargs) -- for example, a partially applied
+                   NagiosPluginFactory
+    @param args:   the command line arguments for the check
+    @return: tuple, (code, output)
+    """
+    stdout, root = sys.stdout, logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    sigalrm = signal.getsignal(signal.SIGALRM)
+    timeout = socket.getdefaulttimeout()
+
+    sys.stdout = capture = StringIO.StringIO()
+    # let NagiosPlugin configure logging against the captured stdout
+    root.handlers = []
+    try:
+        try:
+            plugin(args=args, **kwargs).check()
+        except SystemExit, e:
+            code = e.code
+        except:
+            capture.write('NRPE: Unhandled exception in check\n%s' %
+                          traceback.format_exc())
+            code = UNKN
+        else:
+            # the check returned without calling die
+            code = UNKN
+    finally:
+        signal.alarm(0)
+        signal.signal(signal.SIGALRM, sigalrm)
+        socket.setdefaulttimeout(timeout)
+        root.handlers, root.level = handlers, level
+        sys.stdout = stdout
+
+    if not isinstance(code, int) or code not in range(UNKN + 1):
+        code = UNKN
+    return code, capture.getvalue().rstrip('\n')
+
+class NRPEHandler(SocketServer.BaseRequestHandler):
+    """
+    Reads a single query packet from the client, runs the requested
+    command and replies with a response packet.
+    """
+    def handle(self):
+        # or a client which sends nothing holds an in-place server forever
+        self.request.settimeout(self.server.connection_timeout)
+        data = ''
+        try:
+            while len(data) < NRPEPacket.size:
+                chunk = self.request.recv(NRPEPacket.size - len(data))
+                if not chunk:
+                    return
+                data += chunk
+        except socket.timeout:
+            logging.error('%s: timed out waiting for a query' %
+                          self.client_address[0])
+            return
+
+        try:
+            query = NRPEPacket.unpack(data)
+        except NagiosPluginError, e:
+            logging.error('%s: %s' % (self.client_address[0], e))
+            return
+
+        code, output = self.server.dispatch(query.buffer)
+        response = NRPEPacket(RESPONSE_PACKET, output, code)
+        try:
+            self.request.sendall(response.pack())
+        except socket.timeout:
+            logging.error('%s: timed out sending a response' %
+                          self.client_address[0])
+
+class NRPEServer(SocketServer.TCPServer):
+    """
+    An NRPE compatible server. Commands are registered by name, much like
+    the command[...] definitions found in nrpe.cfg, and are run in place,
+    one at a time.
+
+    >>> server = NRPEServer(('127.0.0.1', 0))
+    >>> server.register('check_nothing', object)
+    >>> server.dispatch('check_unknown')
+    (3, "NRPE: Command 'check_unknown' not defined")
+    >>> server.dispatch('check_nothing!10')
+    (3, 'NRPE: Command arguments are disabled')
+    >>> server.dispatch('_NRPE_CHECK')
+    (0, 'NRPE v2.15 (sysadm nrpe)')
+    >>> server.server_close()
+
+    Arguments are numbered from 1, macros for any other number are empty
+
+    >>> class Echo(object):
+    ...     def __init__(self, args):
+    ...         self.args = args
+    ...     def check(self):
+    ...         print ' '.join(self.args)
+    ...         raise SystemExit(0)
+    >>> server = NRPEServer(('127.0.0.1', 0), allow_arguments=True)
+    >>> server.register('check_echo', Echo, ['$ARG0$', '$ARG1$', '$ARG3$'])
+    >>> server.dispatch('check_echo!one!two')
+    (0, 'one')
+    >>> server.server_close()
+    """
+    allow_reuse_address = True
+
+    def __init__(self, server_address=(DEFAULT_BIND, DEFAULT_PORT),
+                 allow_arguments=False, handler=NRPEHandler,
+                 connection_timeout=DEFAULT_CONNECTION_TIMEOUT):
+        """
+        @param server_address:  the (host, port) pair to listen on
+        @param allow_arguments: mirrors nrpe's dont_blame_nrpe, if True
+                                '!' delimited arguments are substituted for
+                                $ARGn$ macros in the command definition
+        @param connection_timeout: seconds to wait on a client, to send its
+                                query or take the response, before its
+                                connection is closed
+        """
+        SocketServer.TCPServer.__init__(self, server_address, handler)
+        self.allow_arguments = allow_arguments
+        self.connection_timeout = connection_timeout
+        self.commands = {}
+
+    def register(self, name, plugin, args=(), **kwargs):
+        """
+        Registers a command.
+
+        @param name:   the command name, as passed to check_nrpe -c
+        @param plugin: a NagiosPlugin subclass, or callable (see run_inplace)
+        @param args:   the command line arguments for the plugin, possibly
+                       containing $ARGn$ macros
+        @param kwargs: additional keyword arguments for the plugin
+        """
+        self.commands[name] = (plugin, list(args), kwargs)
+
+    def dispatch(self, query):
+        """
+        Runs the command requested by query (in nrpe's 'command!arg1!arg2'
+        format), returning an (exit code, output) pair.
+        """
+        name, macros = query.split('!')[0], query.split('!')[1:]
+        if name == NRPE_CHECK:
+            return 0, NRPE_VERSION
+        if name not in self.commands:
+            return UNKN, "NRPE: Command '%s' not defined" % name
+        if macros and not self.allow_arguments:
+            return UNKN, 'NRPE: Command arguments are disabled'
+
+        plugin, args, kwargs = self.commands[name]
+        def substitute(match):
+            # $ARG1$ is the first argument, there is no $ARG0$
+            n = int(match.group(1))
+            if 1 <= n <= len(macros):
+                return macros[n - 1]
+            return ''
+        # as with nrpe (and the shell) macros without a value disappear
+        args = filter(None, [ARG_MACRO.sub(substitute, arg) for arg in args])
+        return run_inplace(plugin, args, **kwargs)
+
+class ForkingNRPEServer(SocketServer.ForkingMixIn, NRPEServer):
+    """
+    An NRPEServer which handles each request in a fork of the daemon, so
+    checks run concurrently, in a process which has already imported the
+    plugin modules, and cannot disturb the state of the daemon itself.
+    """
+
+def load_config(server, path):
+    """
+    Registers commands with server from an nrpe.cfg style file, where each
+    command definition names a plugin as an importable module:attribute
+    followed by its arguments. For example,
+
+        command[check_example]=mymodule:ExamplePlugin -w 10 -c 20 -N $ARG1$
+
+    Modules are imported once, when the config is loaded.
+    """
+    for line in open(path):
+        line = line.strip()
+        if not line.startswith('command['):
+            continue
+        try:
+            name, definition = line[len('command['):].split(']=', 1)
+            args = shlex.split(definition)
+            module, attribute = args.pop(0).split(':')
+        except ValueError:
+            raise NagiosPluginError('Invalid command definition: %s' % line)
+        __import__(module)
+        server.register(name, getattr(sys.modules[module], attribute), args)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] -C nrpe.cfg')
+    parser.add_option(
+        '-C', '--config', help='the command definition file'
+    )
+    parser.add_option(
+        '-b', '--bind', default=DEFAULT_BIND,
+        help='the address to listen on (default: %s)' % DEFAULT_BIND
+    )
+    parser.add_option(
+        '-P', '--port', type='int', default=DEFAULT_PORT,
+        help='the port to listen on (default: %s)' % DEFAULT_PORT
+    )
+    parser.add_option(
+        '-i', '--inplace', action='store_true', default=False,
+        help='run checks in place, rather than in a fork per request'
+    )
+    parser.add_option(
+        '-a', '--allow-arguments', action='store_true', default=False,
+        help='allow command arguments (see dont_blame_nrpe)'
+    )
+    parser.add_option(
+        '-T', '--connection-timeout', type='int',
+        default=DEFAULT_CONNECTION_TIMEOUT,
+        help='seconds to wait on a client (default: %s)' %
+             DEFAULT_CONNECTION_TIMEOUT
+    )
+
+    opts, args = parser.parse_args()
+    if args: raise parser.error('invalid argument: %r' % args[0])
+    if not opts.config: raise parser.error('a config file is required')
+
+    # plugin modules are typically found alongside the config
+    sys.path.insert(0, os.path.dirname(os.path.abspath(opts.config)))
+    if opts.inplace:
+        server_class = NRPEServer
+    else:
+        server_class = ForkingNRPEServer
+    server = server_class((opts.bind, opts.port), opts.allow_arguments,
+                          connection_timeout=opts.connection_timeout)
+    load_config(server, opts.config)
+    server.serve_forever()
@@ -12,14 +12,20 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import absolute_import
 import os
 import re
 import sys
+import time
 import signal
-import socket
-import logging
+import thread
 import optparse
-import traceback
+import itertools
+from collections import namedtuple
+
+# logging, socket, traceback and fnmatch are imported where they are used,
+# most plugin runs need none of them, and each import adds to the start up
+# time of every check (see benchmarks/bench_startup.py)
 
 """
 nagios/plugin.py Martin Walsh <sysadm@mwalsh.org>
@@ -32,13 +38,18 @@ __package__ = 'sysadm'
 
 __all__ = [
     'OK', 'WARN', 'CRIT', 'UNKN', 'LOG0', 'LOG1', 'LOG2', 'LOG3', 
-    'NagiosArgParser', 'NagiosPlugin', 'UnhandledExceptionHandler',
+    'NagiosArgParser', 'NagiosPlugin', 'NagiosPluginExit', 'NagiosDeadline',
+    'NagiosTimeout', 'NagiosRangeCache', 'NagiosRangeMap', 
+    'UnhandledExceptionHandler',
 ]
 
 # default thresholds
 DEFAULT_WARN = 75
 DEFAULT_CRIT = 90
 
+# numpy is optional, and imported on first use (see _numpy)
+_NUMPY = []
+
 # default socket/sigalrm timeout
 try:
     DEFAULT_TIMEOUT = os.environ['DEFAULT_SOCKET_TIMEOUT']
@@ -59,19 +70,156 @@ LOG3 = 100 # Lots of detail for plugin problem diagnosis
 
 class NagiosPluginError(Exception): pass
 
-class NagiosPerfLabel(object):
+def _log(level, message):
+    """
+    Logs message, if logging is in use -- it is configured by NagiosPlugin 
+    when the plugin imports it, or is run with -v. 
+    """
+    logging = sys.modules.get('logging')
+    if logging is not None:
+        logging.log(level, message)
+
+def _numpy():
+    """
+    Returns the numpy module, or None if it is not installed. The import 
+    is deferred until needed, it is far too slow for every plugin start.
+    """
+    if not _NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _NUMPY.append(numpy)
+    return _NUMPY[0]
+
+class NagiosPluginExit(SystemExit):
     """
-    A collection of performance metrics used for rrd graphing.
+    Raised by NagiosPlugin.die in place of a bare sys.exit, so that 
+    callers running plugins in-process (see nagios/nrpe.py and 
+    nagios/batch.py) can collect the status line, info message and 
+    performance data along with the exit code.
+
+    >>> e = NagiosPluginExit(WARN, 'service WARNING: info', 'info')
+    >>> e.code, e.output, e.info
+    (1, 'service WARNING: info', 'info')
+    >>> isinstance(e, SystemExit)
+    True
+    """
+    def __init__(self, code, output='', info='', performance=None):
+        SystemExit.__init__(self, code)
+        self.output = output
+        self.info = info
+        self.performance = performance
+
+class NagiosTimeout(NagiosPluginError): 
+    """ Raised by NagiosDeadline when a check has run out of time. """
+
+class NagiosDeadline(object):
+    """
+    The time budget of a single check, started when the plugin is created 
+    from its timeout (-t) command line option. Unlike SIGALRM a deadline 
+    is sub-second, belongs to one plugin instance (so concurrent checks in 
+    a single process each have their own), and works in any thread; but 
+    it is cooperative -- sockets, subprocesses and sleeps in the check 
+    should be bounded by the remaining budget, as below. 
+
+    >>> deadline = NagiosDeadline(0.25)
+    >>> 0 < deadline.remaining() <= 0.25
+    True
+    >>> deadline.expired()
+    False
+    >>> deadline.sleep(10)
+    Traceback (most recent call last):
+    ...
+    NagiosTimeout: Plugin timed out after 0.25 second.
+    >>> deadline.remaining()
+    0.0
+    """
+    def __init__(self, timeout):
+        """
+        @param timeout: the time budget, in (fractional) seconds
+        """
+        self.timeout = float(timeout)
+        self.start = time.time()
+        self.end = self.start + self.timeout
+
+    @property
+    def message(self):
+        """ The info message used when the deadline has passed. """
+        if self.timeout > 1: 
+            plural = 's'
+        else:
+            plural = ''
+        return 'Plugin timed out after %0.2f second%s.' % (self.timeout, plural)
+
+    def elapsed(self):
+        """ Returns the seconds spent since the deadline was started. """
+        return time.time() - self.start
+
+    def remaining(self):
+        """ Returns the seconds left before the deadline, never negative. """
+        return max(self.end - time.time(), 0.0)
+
+    def expired(self):
+        return time.time() >= self.end
+
+    def check(self):
+        """ Raises NagiosTimeout if the deadline has passed. """
+        if self.expired():
+            raise NagiosTimeout(self.message)
+
+    def sleep(self, seconds):
+        """
+        Sleeps for seconds, or the remaining budget if less, raising 
+        NagiosTimeout if the deadline passes.
+        """
+        time.sleep(min(seconds, self.remaining()))
+        self.check()
+
+    def settimeout(self, sock):
+        """
+        Sets the timeout of sock to the remaining budget, so that blocking 
+        socket operations fail (with socket.timeout) at the deadline. Call 
+        again before each operation, as the budget shrinks. 
+        """
+        self.check()
+        sock.settimeout(self.remaining())
+        return sock
+
+    def wait(self, process, interval=0.01):
+        """
+        Waits for a subprocess.Popen to exit, returning its returncode. If 
+        the deadline passes first the process is killed, and NagiosTimeout 
+        raised.
+        """
+        while process.poll() is None:
+            if self.expired():
+                process.kill()
+                process.wait()
+                raise NagiosTimeout(self.message)
+            time.sleep(min(interval, self.remaining()))
+        return process.returncode
+
+class NagiosPerfLabel(namedtuple('NagiosPerfLabel', 
+                                 'label value uom warn crit min max')):
+    """
+    A collection of performance metrics used for rrd graphing. Labels are 
+    (immutable) tuples, in the field order of the performance data format, 
+    which keeps them small when a plugin reports many thousands. 
 
     >>> label = NagiosPerfLabel('temp', 75)
     >>> label.value
     75
+    >>> label
+    NagiosPerfLabel(label='temp', value=75, uom='', warn='', crit='', min='', max='')
 
     >>> label = NagiosPerfLabel('temp', 75, 'S', strict=True)
     Traceback (most recent call last):
     ...
     NagiosPluginError: Invalid UOM provided for performance data.
     """
+    __slots__ = ()
+
     # Units of measure allowed in performance data, as 
     # defined by the nagios plugin development guidelines
     allowed_uoms = ['',                         # null, as number (int, float) 
@@ -80,8 +228,8 @@ class NagiosPerfLabel(object):
                     'B', 'KB', 'MB', 'GB', 'TB',# quantity in bytes
                     'c',                        # continuous counter
     ]
-    def __init__(self, label, value, uom='', warn='', 
-                 crit='', min='', max='', strict=False):
+    def __new__(cls, label, value, uom='', warn='', 
+                crit='', min='', max='', strict=False):
         """
         @param label:  the name of the metric 
         @param value:  the value/data produced
@@ -93,18 +241,12 @@ class NagiosPerfLabel(object):
         @param strict: determines if uom is restricted to nagios dev spec
         """
         
-        if strict and uom not in self.allowed_uoms:
+        if strict and uom not in cls.allowed_uoms:
             raise NagiosPluginError(
                     'Invalid UOM provided for performance data.'
             )
             
-        self.label = label
-        self.value = value
-        self.uom = uom
-        self.warn = warn
-        self.crit = crit
-        self.min = min
-        self.max = max
+        return tuple.__new__(cls, (label, value, uom, warn, crit, min, max))
 
 class NagiosPerformance(object):
     """
@@ -128,6 +270,16 @@ class NagiosPerformance(object):
     >>> '%s' % perf
     "|'temp'=75.00;;;;"
 
+    >>> perf.add_label('temp', 80)
+    Traceback (most recent call last):
+    ...
+    NagiosPluginError: Performance labels must be unique.
+
+    >>> perf.add_labels(['cpu0', 'cpu1'], [12.5, 50], '%')
+    >>> perf.format_performance()
+    "|'temp'=75.00;;;; 'cpu0'=12.50%;;;; 'cpu1'=50.00%;;;;"
+    >>> len(perf), 'cpu1' in perf, perf['cpu1'].value
+    (3, True, 50)
 
     >>> perf = NagiosPerformance()
     >>> perf.add_label('temp', 75, 'S', strict=True)
@@ -139,9 +291,13 @@ class NagiosPerformance(object):
 
     """  
     _fmt = "'%(label)s'=%(value)0.2f%(uom)s;%(warn)s;%(crit)s;%(min)s;%(max)s"
+    # _fmt, by position, for formatting labels (tuples) directly
+    _tuple_fmt = "'%s'=%0.2f%s;%s;%s;%s;%s"
 
     def __init__(self):
         self.labels = []
+        # label name -> NagiosPerfLabel, for uniqueness and lookup
+        self.index = {}
         
     def __nonzero__(self):
         """ 
@@ -151,6 +307,16 @@ class NagiosPerformance(object):
         return bool(self.labels)
     # renamed to __bool__ in python 3000
     __bool__ = __nonzero__
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def __getitem__(self, label):
+        """ Returns the NagiosPerfLabel named label. """
+        return self.index[label]
         
     def add_label(self, label, value, uom='', warn='', 
                     crit='', min='', max='', strict=False):
@@ -159,14 +325,44 @@ class NagiosPerformance(object):
         NagiosPluginError if the label provided is not unique.
         See NagiosPerfLabel for a description of the arguments.  
         """   
-        if label in self.labels:
+        if label in self.index:
             raise NagiosPluginError('Performance labels must be unique.')
         else:         
-            self.labels.append(
-                NagiosPerfLabel(
-                    label, value, uom, warn, crit, min, max, strict
-                )
+            perf_label = NagiosPerfLabel(
+                label, value, uom, warn, crit, min, max, strict
             )
+            self.labels.append(perf_label)
+            self.index[label] = perf_label
+
+    def add_labels(self, labels, values, uom='', warn='', 
+                   crit='', min='', max='', strict=False):
+        """
+        Adds many unique labels at once, sharing uom, thresholds and 
+        min/max. Labels and values are sequences of the same length (values 
+        may also be a numpy array). Raises a NagiosPluginError, adding 
+        nothing, if any label is not unique. 
+        """
+        if strict and uom not in NagiosPerfLabel.allowed_uoms:
+            raise NagiosPluginError(
+                    'Invalid UOM provided for performance data.'
+            )
+        if hasattr(values, 'tolist'):
+            # numpy scalars format far slower than python floats
+            values = values.tolist()
+        labels, values = list(labels), list(values)
+        if len(labels) != len(values):
+            raise NagiosPluginError('Too few values, or too many labels.')
+        unique = set(labels)
+        if len(unique) != len(labels) or not unique.isdisjoint(self.index):
+            raise NagiosPluginError('Performance labels must be unique.')
+
+        new = tuple.__new__
+        perf_labels = [
+            new(NagiosPerfLabel, (label, value, uom, warn, crit, min, max))
+            for label, value in zip(labels, values)
+        ]
+        self.labels.extend(perf_labels)
+        self.index.update(zip(labels, perf_labels))
         
     def format_performance(self):
         """
@@ -174,7 +370,10 @@ class NagiosPerformance(object):
         described in the nagios-plugin development guidelines. 
         """ 
         if self.labels:
-            o = [self._fmt % label.__dict__ for label in self.labels]
+            if self._fmt == NagiosPerformance._fmt:
+                o = map(self._tuple_fmt.__mod__, self.labels)
+            else:
+                o = [self._fmt % label._asdict() for label in self.labels]
             return '|'+' '.join(o)
         else:
             return '' 
@@ -182,6 +381,84 @@ class NagiosPerformance(object):
     __repr__ = __str__ = format_performance
 
 
+class NagiosRangeCache(object):
+    """
+    A bounded, least recently used, cache of compiled range definitions, 
+    shared by all NagiosRange instances, so that each distinct definition 
+    is parsed only once. 
+
+    >>> cache = NagiosRangeCache(maxsize=2)
+    >>> cache.get('10') is None
+    True
+    >>> cache.put('10', 'compiled 10')
+    >>> cache.put('20', 'compiled 20')
+    >>> cache.get('10')
+    'compiled 10'
+    >>> cache.put('30', 'compiled 30') # evicts '20', the least recently used
+    >>> cache.get('20') is None
+    True
+    >>> sorted(cache.info().items())
+    [('hits', 1), ('maxsize', 2), ('misses', 2), ('size', 2)]
+    """
+    def __init__(self, maxsize=1024):
+        """
+        @param maxsize: the maximum number of definitions to hold
+        """
+        self.maxsize = maxsize
+        self.hits = self.misses = 0
+        self.__entries = {}
+        # recency is a counter value per key, rather than an ordering, so 
+        # that hits are plain dict operations (and need no lock) -- a hit 
+        # racing an eviction may leave a key here without an entry, which 
+        # put tolerates, and drops once it is old enough
+        self.__used = {}
+        self.__tick = itertools.count().next
+        self.__lock = thread.allocate_lock()
+
+    def get(self, key):
+        """ Returns the cached value for key, or None. """
+        try:
+            value = self.__entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.__used[key] = self.__tick()
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self.__lock:
+            self.__entries[key] = value
+            self.__used[key] = self.__tick()
+            if len(self.__entries) > self.maxsize:
+                # evict the least recently used quarter at once, so that 
+                # the cost of sorting is spread across many inserts
+                keep = self.maxsize - self.maxsize // 4
+                # items() copies atomically, unlike iterating __used while 
+                # unlocked hits add to it
+                used = sorted(self.__used.items(), key=lambda item: item[1])
+                for key, tick in used:
+                    if len(self.__entries) <= keep:
+                        break
+                    self.__entries.pop(key, None)
+                    self.__used.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__used.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """ Returns a dict of cache statistics. """
+        return dict(hits=self.hits, misses=self.misses, 
+                    maxsize=self.maxsize, size=len(self.__entries))
+
+def _not_a_number(value):
+    raise ValueError("Value '%s' is not a number." % value)
+
 class NagiosRange(object):
     """
     Object representing a range as defined by the nagios-plugin
@@ -241,7 +518,13 @@ class NagiosRange(object):
     Traceback (most recent call last):
     ...
     NagiosPluginError: Invalid end value '10:20@' in 'unknown' range.
+
+    Each distinct definition is parsed once, and compiled into a comparison 
+    specialised for its shape, which is kept in NagiosRange.cache for reuse 
+    by later instances (in multi-metric plugins, or long-lived processes). 
     """
+    cache = NagiosRangeCache()
+
     def __init__(self, range, type='unknown'):
         """
         @param range:  the range definition, None effectively disables 
@@ -250,15 +533,26 @@ class NagiosRange(object):
         """ 
         self.range = range
         self.type = type
-        # defaults 
-        self.start = 0
-        self.start_infinity = False
-        self.end = 0
-        self.end_infinity = True
-        # alert_on
-        self.inside = False
-        
-        self.__parse_range()
+
+        compiled = self.cache.get(range)
+        if compiled is None:
+            # defaults 
+            self.start = 0
+            self.start_infinity = False
+            self.end = 0
+            self.end_infinity = True
+            # alert_on
+            self.inside = False
+            
+            self.__parse_range()
+            compiled = (self.start, self.start_infinity, self.end, 
+                        self.end_infinity, self.inside, self.__compile())
+            self.cache.put(range, compiled)
+
+        # the compiled function is check_range itself, for this instance, 
+        # saving a method call per check
+        (self.start, self.start_infinity, self.end, self.end_infinity,
+         self.inside, self.check_range) = compiled
 
     def __eq__(self, other):
         return (self.range, self.type) == (other.range, other.type)
@@ -314,41 +608,191 @@ class NagiosRange(object):
             else:
                 self.end_infinity = False
                 
-    def check_range(self, value):
+    def __compile(self):
         """
-        Check if the value is outside of the range definition (or inside 
-        the range if this is an inclusive range). 
-        
-        @param value: the value to check
-        @return: bool, True if outside the threshold, False otherwise
+        Private method returning check_range, a function of one value 
+        specialised for the shape of the parsed range, which is True if the 
+        value is outside of the range (or inside, if this is an inclusive 
+        range), and raises ValueError if the value is not a number. 
         """
-        if type(value) not in (int, long, float):
-            raise ValueError("Value '%s' is not a number." % value)
-        
+        numbers = (int, long, float)
         if self.range is None:
-            return False
-                
+            def check_range(value):
+                if type(value) not in numbers: _not_a_number(value)
+                return False
+            return check_range
+
+        start, end, inside = self.start, self.end, self.inside
+        # the comparisons are spelled out (rather than negating an inrange 
+        # function) to save a call per check, 'not' keeps the nan behaviour
         if not self.start_infinity and not self.end_infinity:
-            if self.start <= value <= self.end:
-                inrange = True
+            if inside:
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return start <= value <= end
             else:
-                inrange = False
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return not start <= value <= end
         elif not self.start_infinity and self.end_infinity:
-            if self.start <= value:
-                inrange = True
+            if inside:
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return start <= value
             else:
-                inrange = False
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return not start <= value
         elif self.start_infinity and not self.end_infinity:
-            if value <= self.end:
-                inrange = True
+            if inside:
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return value <= end
             else:
-                inrange = False
-                
+                def check_range(value):
+                    if type(value) not in numbers: _not_a_number(value)
+                    return not value <= end
+        else: # '~:', the whole number line
+            def check_range(value):
+                if type(value) not in numbers: _not_a_number(value)
+                return inside
+        check_range.__doc__ = NagiosRange.check_range.__doc__
+        return check_range
+
+    def check_range(self, value):
+        """
+        Check if the value is outside of the range definition (or inside 
+        the range if this is an inclusive range). Each instance replaces 
+        this method with the function compiled for its range (see 
+        __compile), which behaves the same. 
+        
+        @param value: the value to check
+        @return: bool, True if outside the threshold, False otherwise
+        """
+        return self.__compile()(value)
+
+    def check_range_array(self, values):
+        """
+        Check many values at once, as check_range does one. If numpy is 
+        installed the comparison is vectorized, and values may be a numpy 
+        array, or any sequence or buffer numpy.asarray accepts. Otherwise 
+        check_range is applied to each value in turn. 
+
+        >>> rnge = NagiosRange('@10:20')
+        >>> list(rnge.check_range_array([5, 10, 15.5, 20, 25]))
+        [False, True, True, True, False]
+        >>> list(NagiosRange('~:10').check_range_array([-1e9, 10, 11]))
+        [False, False, True]
+        >>> list(NagiosRange(None).check_range_array([1, 2]))
+        [False, False]
+        >>> NagiosRange('10').check_range_array(['10'])
+        Traceback (most recent call last):
+        ...
+        ValueError: Values are not numbers.
+
+        @param values: the values to check
+        @return: a numpy array of bool (or a list of bool, without numpy), 
+                 True where the value is outside the threshold
+        """
+        np = _numpy()
+        if np is None:
+            try:
+                return [self.check_range(value) for value in values]
+            except ValueError:
+                raise ValueError('Values are not numbers.')
+
+        values = np.asarray(values)
+        if values.dtype.kind not in 'iuf':
+            raise ValueError('Values are not numbers.')
+        if self.range is None:
+            return np.zeros(values.shape, dtype=bool)
+
+        inrange = np.ones(values.shape, dtype=bool)
+        if not self.start_infinity:
+            inrange &= self.start <= values
+        if not self.end_infinity:
+            inrange &= values <= self.end
+
         if self.inside:
             return inrange
         else:
-            return not inrange
+            return ~inrange
         
+class NagiosRangeMap(object):
+    """
+    Ranges for many named metrics (performance labels), defined as a comma 
+    separated list of label=range pairs. Labels are matched exactly, or as 
+    a glob (containing any of *?[), or as a regular expression (between 
+    slashes, and without commas). Exact labels are found first, by dict 
+    lookup, then patterns are tried in the order given -- '*' matches 
+    anything not matched sooner. Labels matching nothing have a disabled 
+    range (NagiosRange(None)). Matches are remembered, so that each label 
+    costs a single dict lookup after the first. 
+
+    >>> ranges = NagiosRangeMap('sda=80,sdb=90,sd*=85,/^md[0-9]+$/=95,*=75')
+    >>> [str(ranges[label]) for label in ('sda', 'sdc', 'md0', 'eth0')]
+    ['80', '85', '95', '75']
+    >>> str(ranges.default)
+    '75'
+
+    >>> ranges = NagiosRangeMap('sda=80,sdb', 'warning')
+    Traceback (most recent call last):
+    ...
+    NagiosPluginError: Invalid label=range pair 'sdb' in 'warning' range.
+    """
+    def __init__(self, definition, type='unknown', maxsize=65536):
+        """
+        @param definition: the label=range pairs
+        @param type:       the threshold type (warning|critical)
+        @param maxsize:    the number of pattern matches to remember
+        """
+        self.definition = definition
+        self.type = type
+        self.exact = {}
+        self.patterns = []
+        self.disabled = NagiosRange(None, type)
+        # the range for labels matching nothing but '*'
+        self.default = self.disabled
+        for pair in definition.split(','):
+            label, sep, range = pair.strip().rpartition('=')
+            if not sep or not label:
+                message = "Invalid label=range pair '%s' in '%s' range."
+                raise NagiosPluginError(message % (pair, type))
+
+            range = NagiosRange(range, type)
+            if label == '*':
+                self.default = range
+            if label.startswith('/') and label.endswith('/') and len(label) > 1:
+                self.patterns.append((re.compile(label[1:-1]), range))
+            elif any(c in label for c in '*?['):
+                import fnmatch
+                self.patterns.append(
+                        (re.compile(fnmatch.translate(label)), range)
+                )
+            else:
+                self.exact[label] = range
+
+        self.matches = NagiosRangeCache(maxsize)
+
+    def __getitem__(self, label):
+        """ Returns the NagiosRange for label. """
+        try:
+            return self.exact[label]
+        except KeyError:
+            pass
+        range = self.matches.get(label)
+        if range is None:
+            range = self.disabled
+            for pattern, candidate in self.patterns:
+                if pattern.match(label):
+                    range = candidate
+                    break
+            self.matches.put(label, range)
+        return range
+
+    def __str__(self):
+        return self.definition
+
 class NagiosThresholds(object):
     """
     A collection of ranges as defined by the nagios-plugin
@@ -362,6 +806,13 @@ class NagiosThresholds(object):
     >>> th = NagiosThresholds('10#', '$30')
     >>> assert th.warning == NagiosRange(None, 'warning')
     >>> assert th.critical == NagiosRange(None, 'critical')
+
+    Either range may instead be a NagiosRangeMap definition, giving 
+    thresholds per label (the plain ranges are then those for '*').
+
+    >>> th = NagiosThresholds('sda=80,*=75', '90')
+    >>> [str(r) for r in th.ranges('sda')], str(th.warning)
+    (['80', '90'], '75')
     """
     def __init__(self, warningRange, criticalRange):
         """
@@ -370,17 +821,38 @@ class NagiosThresholds(object):
         
         NOTE: invalid nagios range definitions are silently ignored
         """
+        self.warning, self.warning_map = self.__build(warningRange, 'warning')
+        self.critical, self.critical_map = self.__build(
+                criticalRange, 'critical'
+        )
+
+    def __build(self, definition, type):
+        """
+        Private method returning the range, and range map (if any), for 
+        definition.
+        """
         try:
-            self.warning = NagiosRange(warningRange, 'warning')
-        except NagiosPluginError, e:
-            logging.log(LOG2, e.message)
-            self.warning = NagiosRange(None, 'warning')
-    
-        try:
-            self.critical = NagiosRange(criticalRange, 'critical')
+            if definition is not None and '=' in definition:
+                ranges = NagiosRangeMap(definition, type)
+                return ranges.default, ranges
+            return NagiosRange(definition, type), None
         except NagiosPluginError, e:
-            logging.log(LOG2, e.message)
-            self.critical = NagiosRange(None, 'critical')
+            _log(LOG2, e.message)
+            return NagiosRange(None, type), None
+
+    @property
+    def labelled(self):
+        """ True if either threshold is defined per label. """
+        return self.warning_map is not None or self.critical_map is not None
+
+    def ranges(self, label):
+        """ Returns the (warning, critical) pair of ranges for label. """
+        warning, critical = self.warning, self.critical
+        if self.warning_map is not None:
+            warning = self.warning_map[label]
+        if self.critical_map is not None:
+            critical = self.critical_map[label]
+        return warning, critical
         
 class NagiosArgParser(object):
     """
@@ -402,9 +874,11 @@ class NagiosArgParser(object):
         self.optionparser = optparse.OptionParser(*args, **kwargs)
         # nagios thresholds
         self.add_option('-w', '--warning', dest='warning', default=None,  
-                        help='warning range threshold def')
+                        help='warning range threshold def (or label=range,'
+                        '... pairs)')
         self.add_option('-c', '--critical', dest='critical', default=None, 
-                        help='critical range threshold def')
+                        help='critical range threshold def (or label=range,'
+                        '... pairs)')
         # other nagios reserved
         self.add_option('-v', '--verbose', action='count', dest='verbosity', 
                         help='increase verbosity')
@@ -414,6 +888,12 @@ class NagiosArgParser(object):
                         help='hostname or ip address to check')
         self.add_option('-t', '--timeout', dest='timeout', type='float', 
                         default=DEFAULT_TIMEOUT, help='script timeout')
+        # instrumentation, see NagiosPlugin.timings
+        self.add_option('--timings', action='store_true', default=False,
+                        dest='timings', help='add the time taken by each '
+                        'phase of the plugin to the performance data')
+        self.add_option('--profile', dest='profile', metavar='FILE',
+                        help='write a profile of the plugin to FILE')
     __init__.__doc__ = optparse.OptionParser.__init__.__doc__
             
     def add_option(self, *args, **kwargs):
@@ -446,9 +926,12 @@ class UnhandledExceptionHandler(object):
         def wrapper(instance, *args, **kwargs):
             try:
                 func(instance, *args, **kwargs)
-            except SystemExit, e:
-                sys.exit(e.code)
+            except SystemExit:
+                raise
+            except NagiosTimeout, e:
+                instance.die(CRIT, str(e), cancel_alarm=False)
             except:
+                import traceback
                 instance.die(UNKN, self._fmt % traceback.format_exc())
                 
         return wrapper
@@ -475,11 +958,12 @@ def camel_to_under(word):
     >>> camel_to_under('CamelToUnder2nd')
     'camel_to_under_2nd'
     """
-    
-    pattern = re.compile(
-            r"(?<!^)(((?<=[a-z])[A-Z])|((?<![0-9])[0-9](?=[a-z])))"
-    )
-    return pattern.subn(r"_\1", word, 0)[0].lower()
+    return _CAMEL.subn(r"_\1", word, 0)[0].lower()
+
+_CAMEL = re.compile(r"(?<!^)(((?<=[a-z])[A-Z])|((?<![0-9])[0-9](?=[a-z])))")
+
+# class name -> service name (see NagiosPlugin.service)
+_SERVICE_NAMES = {}
 
 class NagiosPlugin(object):
     """
@@ -489,6 +973,26 @@ class NagiosPlugin(object):
     Subclasses should, at a minimum override the 'check' method, which may or
     may not be decorated with @UnhandledExceptionHandler(), to trap unhandled 
     exceptions, at the subclass author's discretion. 
+
+    Each instance carries a NagiosDeadline (self.deadline) started from the 
+    timeout option, which checks should consult to bound blocking calls, 
+    for example self.deadline.settimeout(sock) before each socket operation.
+    A NagiosTimeout raised by the deadline in a decorated check ends it 
+    with the same output as a SIGALRM. 
+
+    The seconds spent in each phase are kept in self.timings: init (the 
+    constructor), check (from the constructor to die), thresholds (within 
+    check_thresholds), die, and runtime (all but die). The --timings option 
+    adds them to the performance data, and --profile writes them, with 
+    cProfile statistics, to a file. 
+
+    >>> plugin = NagiosPlugin(args=['--timings'], standalone=False)
+    >>> code = plugin.check_thresholds(10)
+    >>> try:
+    ...     plugin.die(code, 'done')
+    ... except NagiosPluginExit, e:
+    ...     [label.label for label in e.performance.labels]
+    ['plugin_runtime', 'plugin_init', 'plugin_check', 'plugin_thresholds']
     """
     __plugin_version__ = '$Revision: 0.1 $'
     
@@ -503,8 +1007,13 @@ class NagiosPlugin(object):
     }
     
     _fmt = '%(service)s %(status)s: %(info)s%(perf)s'
+
+    # a NagiosPerfSpool (see nagios/spool.py) to which die appends the 
+    # performance data of each check, if set
+    spool = None
     
-    def __init__(self, parser=None, network=True):
+    def __init__(self, parser=None, network=True, args=None, 
+                 standalone=True):
         """
         @param parser: a customized command line parser (optional)
         @param network: determines if the default socket timeout should be
@@ -513,33 +1022,42 @@ class NagiosPlugin(object):
                         line option, and the sigalrm is set to same + 
                         SIGALRM_OFFSET, otherwise the a sigalrm is set with
                         the value of the timeout command line option)
+        @param args:    the command line arguments to parse (optional, 
+                        defaults to sys.argv[1:])
+        @param standalone: if True (the default) the plugin owns the process,
+                        logging is configured, die writes the status line to 
+                        stdout, and the timeout is enforced by SIGALRM (and 
+                        the default socket timeout). Otherwise process-wide 
+                        state is left alone, so that many plugins may run 
+                        side by side in one interpreter (see nagios/batch.py)
         """
+        started = time.time()
+        # seconds spent in each phase, see die
+        self.timings = dict(init=0.0, check=0.0, thresholds=0.0, die=0.0,
+                            runtime=0.0)
+        self.__started = self.__checking = started
+        self.__profiler = None
+
         if not isinstance(parser, NagiosArgParser): 
             parser = NagiosArgParser()
             
         self.performance = NagiosPerformance()
+        self.standalone = standalone
         
-        options, args = parser.parse_args()
+        options, args = parser.parse_args(args)
+        # the time budget for check, see NagiosDeadline
+        self.deadline = NagiosDeadline(options.timeout)
         
-        logging.addLevelName(LOG0, 'L0')
-        logging.addLevelName(LOG1, 'L1')
-        logging.addLevelName(LOG2, 'L2')
-        logging.addLevelName(LOG3, 'L3')
-        logging.basicConfig(
-            level=options.verbosity, format='%(message)s', stream=sys.stdout
-        )
+        # logging is configured only if it will be used, the status line 
+        # itself is written directly (see die)
+        if standalone and (options.verbosity < LOG0 or 
+                           'logging' in sys.modules):
+            self.__configure_logging(options.verbosity)
         
         # if version option then die peacefully            
         if options.version: self.__print_revision()
             
-        if network:
-            socket.setdefaulttimeout(options.timeout)
-            signal_timeout = options.timeout + 1
-        else:
-            signal_timeout = options.timeout
-            
-        signal.signal(signal.SIGALRM, self.__handle_sigalrm)
-        signal.alarm(int(signal_timeout)) # requires int 
+        if standalone: self._set_timeout(network)
             
         self.thresholds = NagiosThresholds(options.warning, options.critical)
         
@@ -547,29 +1065,133 @@ class NagiosPlugin(object):
         self.warning = self.thresholds.warning
         self.critical = self.thresholds.critical
         self.options, self.args = options, args
+
+        if options.profile: self.__start_profile()
+        self.__checking = time.time()
+        self.timings['init'] = self.__checking - started
         
+    def __configure_logging(self, level):
+        """
+        Private method which sends log messages of level, and above, to 
+        stdout.
+        """
+        import logging
+        logging.addLevelName(LOG0, 'L0')
+        logging.addLevelName(LOG1, 'L1')
+        logging.addLevelName(LOG2, 'L2')
+        logging.addLevelName(LOG3, 'L3')
+        logging.basicConfig(level=level, format='%(message)s', 
+                            stream=sys.stdout)
+
+    def __start_profile(self):
+        """
+        Private method which profiles the plugin from here to die, with
+        cProfile and (where available, python 3.4 and later) tracemalloc.
+        """
+        import cProfile
+        try:
+            import tracemalloc
+            tracemalloc.start()
+        except ImportError:
+            pass
+        self.__profiler = cProfile.Profile()
+        self.__profiler.enable()
+
+    def __write_profile(self):
+        """
+        Private method which writes the phase timings, the 30 most costly 
+        calls, and the 20 largest allocations (or the peak resident size, 
+        without tracemalloc) to the --profile file.
+        """
+        import pstats
+        self.__profiler.disable()
+        out = open(self.options.profile, 'w')
+        try:
+            out.write('%s timings (seconds)\n' % self.service)
+            for phase in ('init', 'check', 'thresholds', 'die', 'runtime'):
+                out.write('  %-12s %0.6f\n' % (phase, self.timings[phase]))
+            out.write('\n')
+            stats = pstats.Stats(self.__profiler, stream=out)
+            stats.sort_stats('cumulative').print_stats(30)
+
+            tracemalloc = sys.modules.get('tracemalloc')
+            if tracemalloc is not None and tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot()
+                out.write('largest allocations\n')
+                for stat in snapshot.statistics('lineno')[:20]:
+                    out.write('  %s\n' % stat)
+                tracemalloc.stop()
+            else:
+                import resource
+                out.write('peak resident size: %d KB\n' % resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss)
+        finally:
+            out.close()
+
+    def __add_timings(self):
+        """
+        Private method which adds the phase timings to the performance data,
+        as the reserved labels plugin_runtime, plugin_init, plugin_check and
+        plugin_thresholds (in milliseconds, two decimal places of seconds 
+        would hide most of them), unless the check used them itself.
+        """
+        for phase in ('runtime', 'init', 'check', 'thresholds'):
+            label = 'plugin_' + phase
+            if label not in self.performance:
+                self.performance.add_label(
+                        label, self.timings[phase] * 1000, 'ms'
+                )
+
+    def _set_timeout(self, network):
+        """
+        Arms the SIGALRM which ends a standalone plugin when it runs out of 
+        time, and the default socket timeout (see the network argument of 
+        the constructor). Subclasses enforcing the timeout by other means 
+        (as does AsyncNagiosPlugin, see nagios/aio.py) may override this. 
+        """
+        if network:
+            import socket
+            socket.setdefaulttimeout(self.deadline.timeout)
+            signal_timeout = self.deadline.timeout + 1
+        else:
+            signal_timeout = self.deadline.timeout
+
+        signal.signal(signal.SIGALRM, self.__handle_sigalrm)
+        signal.setitimer(signal.ITIMER_REAL, signal_timeout)
+
     def __handle_sigalrm(self, signum, frame):
         """
         Private method for processing a SIGALRM.
         """
-        if self.options.timeout > 1: 
-            plural = 's'
-        else:
-            plural = ''
-            
-        self.die(CRIT, 'Plugin timed out after %0.2f second%s.' % \
-                 (self.options.timeout, plural), cancel_alarm=False)
+        self.die(CRIT, self.deadline.message, cancel_alarm=False)
                
     def __print_revision(self):
         """  
         Private method which responds to the -V (--version) command line option.
         """
         revision = '%s (%s %s) %s' % (
-            camel_to_under(self.__class__.__name__), self.__package_name__, 
+            self.service, self.__package_name__, 
             self.__package_version__, self.__plugin_version__
         )
-        logging.log(LOG0, revision)
-        sys.exit(OK)
+        if self.standalone: self._write(revision)
+        raise NagiosPluginExit(OK, revision)
+
+    @property
+    def service(self):
+        """
+        The service name in the status line, the class name converted by 
+        camel_to_under (once per class). 
+        """
+        name = self.__class__.__name__
+        try:
+            return _SERVICE_NAMES[name]
+        except KeyError:
+            service = _SERVICE_NAMES[name] = camel_to_under(name)
+            return service
+
+    def _write(self, output):
+        """ Writes a line of output, the status line, to stdout. """
+        sys.stdout.write(output + '\n')
 
     def __format_dict(self, status, info):
         """
@@ -577,42 +1199,112 @@ class NagiosPlugin(object):
         signature provided by _fmt.
         """ 
         return dict(
-            service = camel_to_under(self.__class__.__name__), 
+            service = self.service, 
             status = status,  
             info = info, 
             perf = self.performance.format_performance()
         )
         
-    def check_thresholds(self, value):
+    def check_thresholds(self, value, label=None):
         """
         Check both thresholds (warning and range) against value, and return 
         the appropriate status code
         
         @param value:    the value to check
+        @param label:    the name of the metric, selecting its thresholds 
+                         when they are defined per label (see NagiosRangeMap)
         @return: int (one of OK, WARN, CRIT, or UNKN)
+
+        >>> plugin = NagiosPlugin(args=['-w', 'sda=10,*=20', '-c', '30'], 
+        ...                       standalone=False)
+        >>> [plugin.check_thresholds(15, label) for label in ('sda', 'sdb')]
+        [1, 0]
+        >>> plugin.check_thresholds(15)
+        0
         """      
-        if self.critical is not None and self.critical.check_range(value):
+        started = time.time()
+        critical, warning = self.critical, self.warning
+        if label is not None and self.thresholds.labelled:
+            warning, critical = self.thresholds.ranges(label)
+
+        if critical is not None and critical.check_range(value):
             code = CRIT
-        elif self.warning is not None and self.warning.check_range(value):
+        elif warning is not None and warning.check_range(value):
             code = WARN
         else:
             code = OK
             
+        self.timings['thresholds'] += time.time() - started
         return code
+
+    def check_thresholds_array(self, values):
+        """
+        Check both thresholds against many values at once, vectorized if 
+        numpy is installed (see NagiosRange.check_range_array). 
+
+        >>> plugin = NagiosPlugin(args=['-w', '10', '-c', '20'], 
+        ...                       standalone=False)
+        >>> codes, worst = plugin.check_thresholds_array([5, 15, 25, 10])
+        >>> list(codes), worst
+        ([0, 1, 2, 0], 2)
+        
+        @param values: the values to check
+        @return: tuple, a numpy array of status codes (or a list, without 
+                 numpy) and the worst (highest) of them
+        """
+        np = _numpy()
+        if np is None:
+            codes = [self.check_thresholds(value) for value in values]
+            return codes, max(codes or [OK])
+
+        started = time.time()
+        values = np.asarray(values)
+        codes = np.zeros(values.shape, dtype=np.int8)
+        if self.warning is not None:
+            codes[self.warning.check_range_array(values)] = WARN
+        if self.critical is not None:
+            codes[self.critical.check_range_array(values)] = CRIT
+        self.timings['thresholds'] += time.time() - started
+        if codes.size:
+            return codes, int(codes.max())
+        return codes, OK
                 
     def die(self, code, info, cancel_alarm=True):
         """
         Die gracefully, with appropriate output, canceling 
-        the SIGALRM if necessary.
+        the SIGALRM if necessary. Raises NagiosPluginExit, which 
+        exits the interpreter unless caught.
+
+        The time taken by each phase of the plugin (see timings) is 
+        recorded here, added to the performance data with --timings, and 
+        written with the profile with --profile. 
         """
+        started = time.time()
+        timings = self.timings
+        timings['check'] = started - self.__checking
+        timings['runtime'] = started - self.__started
+        options = getattr(self, 'options', None)
+        if options is not None and options.timings: self.__add_timings()
+
         if cancel_alarm: 
-            signal.alarm(0)
+            if self.standalone: signal.setitimer(signal.ITIMER_REAL, 0)
             message_map = self.__format_dict(self.codewords[code], info)
         else:
             message_map = self.__format_dict('SIGALRM', info)
-        logging.log(LOG0, self._fmt % message_map)
+        output = self._fmt % message_map
+        if self.standalone: self._write(output)
+        if self.spool is not None and self.performance:
+            try:
+                self.spool.append(self.performance, message_map['service'])
+                # a standalone plugin exits next, a daemon writes in batches
+                if self.standalone: self.spool.flush()
+            except (IOError, OSError, ValueError, NagiosPluginError), e:
+                # eg. a full spool, the exit status is still the check's
+                _log(LOG1, 'Could not spool performance data: %s' % e)
+        timings['die'] = time.time() - started
+        if self.__profiler is not None: self.__write_profile()
         
-        sys.exit(code)
+        raise NagiosPluginExit(code, output, info, self.performance)
         
     @UnhandledExceptionHandler()
     def check(self):
@@ -640,11 +1332,21 @@ class NagiosPluginFactory(object):
                          NagiosArgParser
     @param network:      mirrors the NagiosPlugin constructor (set a socket 
                          timeout)
+    @param args:         mirrors the NagiosPlugin constructor (command line 
+                         arguments to parse)
+    @param standalone:   mirrors the NagiosPlugin constructor 
     """
-    def __init__(self, plugin_name, check_function, parser=None, network=True):
-        self.plugin = NagiosPlugin(parser, network)
-        self.plugin.__class__.__name__ = plugin_name
+    plugin_class = NagiosPlugin
+
+    def __init__(self, plugin_name, check_function, parser=None, network=True,
+                 args=None, standalone=True):
+        # a class of its own, renaming NagiosPlugin would rename them all
+        plugin_class = type(plugin_name, (self.plugin_class,), {})
+        self.plugin = plugin_class(parser, network, args, standalone)
         self.plugin.check = check_function
+        # shortcuts/aliases
+        self.options = self.plugin.options
+        self.deadline = self.plugin.deadline
 
     def __format_message(self, message, value, code):
         return message % dict(
@@ -654,7 +1356,14 @@ class NagiosPluginFactory(object):
     @UnhandledExceptionHandler()
     def check(self, perf_labels=None, *args, **kwargs):
         responses = self.plugin.check(*args, **kwargs)
-        
+        self.respond(responses, perf_labels)
+
+    def respond(self, responses, perf_labels=None):
+        """
+        Adds performance data for, and checks the thresholds of, the 
+        (value, message) pairs returned by the check function, then dies 
+        with the worst status. 
+        """
         if perf_labels:
             for i, label in enumerate(perf_labels):
                 try:
@@ -666,9 +1375,12 @@ class NagiosPluginFactory(object):
                 else:
                     self.plugin.performance.add_label(label, value)
 
+        labels = list(perf_labels or [])
+        labels += [None] * (len(responses) - len(labels))
+
         codes = []; messages = []
-        for value, message in responses:
-            code = self.plugin.check_thresholds(value)
+        for (value, message), label in zip(responses, labels):
+            code = self.plugin.check_thresholds(value, label)
             messages.append(self.__format_message(message, value, code))
             codes.append(code)
             
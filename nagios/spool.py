@@ -0,0 +1,412 @@
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import time
+import mmap
+import fcntl
+import struct
+from collections import namedtuple
+
+from plugin import NagiosPluginError, _numpy
+
+"""
+nagios/spool.py Martin Walsh <sysadm@mwalsh.org>
+    A compact binary spool of performance data, for graphing and trending
+    tools which would otherwise re-parse the text perfdata of every check.
+    Each label is a fixed width record (see RECORD), and strings (service
+    names, labels, units and thresholds) are stored once, in a string table
+    alongside the spool (path + '.strings'), and referred to by number.
+
+    spool = NagiosPerfSpool('/var/spool/nagios/perf.bin')
+    CheckDisk.spool = spool   # every CheckDisk.die appends its labels
+    ...
+    for record in NagiosPerfSpoolReader(spool.path).slice(start, end):
+        print record.service, record.label, record.value
+"""
+
+__all__ = ['NagiosPerfSpool', 'NagiosPerfSpoolReader', 'SpoolRecord']
+
+# magic, record size
+HEADER = struct.Struct('<8sI4x')
+MAGIC = 'NPSPOOL1'
+
+# timestamp, value, min, max (nan if empty or unknown), then the string ids
+# of service, label, uom, warn and crit
+RECORD = struct.Struct('<ddddIIIII4x')
+
+# numpy.dtype of RECORD, see NagiosPerfSpoolReader.array
+DTYPE = [
+    ('timestamp', '<f8'), ('value', '<f8'), ('min', '<f8'), ('max', '<f8'),
+    ('service', '<u4'), ('label', '<u4'), ('uom', '<u4'), ('warn', '<u4'),
+    ('crit', '<u4'), ('pad', 'V4'),
+]
+
+NAN = float('nan')
+
+SpoolRecord = namedtuple('SpoolRecord',
+        'timestamp service label value uom warn crit min max')
+
+def _number(value):
+    """ Returns value (None, '', or a number, or its string) as a float. """
+    if value is None or value == '':
+        return NAN
+    return float(value)
+
+def _string(value):
+    """ Returns value as a str for the string table, or raises ValueError. """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    if '\n' in value:
+        raise ValueError('spooled strings may not contain newlines')
+    return value
+
+def _encode(timestamp, service, label):
+    """
+    Returns the buffered form of a label: its timestamp, value, min and
+    max as floats, then its service, label, uom, warn and crit as strings.
+    Raises ValueError (or TypeError) if the label cannot be spooled.
+    """
+    label, value, uom, warn, crit, min, max = label
+    return (float(timestamp), _number(value), _number(min), _number(max),
+            _string(service), _string(label), _string(uom), _string(warn),
+            _string(crit))
+
+class _StringTable(object):
+    """
+    The strings of a spool, one per line, numbered from 0 (always ''). The
+    table is only ever appended to, so a writer need only read what other
+    writers have added since it last looked (see sync).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.strings = ['']
+        self.ids = {'': 0}
+        self.offset = 0
+
+    def sync(self):
+        """ Reads strings appended since the last sync. """
+        try:
+            fileobj = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            fileobj.seek(self.offset)
+            data = fileobj.read()
+        finally:
+            fileobj.close()
+        # a string is only complete once its newline is written, and split 
+        # on newlines alone (not splitlines), as strings may hold '\r' etc
+        end = data.rfind('\n') + 1
+        for string in data[:end].split('\n')[:-1]:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        self.offset += end
+
+    def intern(self, strings):
+        """
+        Returns the ids of strings, appending any which are new to the
+        table. Writers must hold the spool lock (see NagiosPerfSpool.flush).
+        """
+        self.sync()
+        ids, new = self.ids, []
+        for string in strings:
+            if string not in ids:
+                if '\n' in string:
+                    raise NagiosPluginError(
+                            'Spooled strings may not contain newlines.'
+                    )
+                ids[string] = len(self.strings)
+                self.strings.append(string)
+                new.append(string)
+        if new:
+            data = ''.join(string + '\n' for string in new)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0644)
+            try:
+                # drop any partial string, left by a writer which died
+                os.ftruncate(fd, self.offset)
+                os.lseek(fd, self.offset, os.SEEK_SET)
+                os.write(fd, data)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.offset += len(data)
+        return [ids[string] for string in strings]
+
+class NagiosPerfSpool(object):
+    """
+    Appends performance data to a binary spool. Labels are buffered, and
+    written (and fsynced) a batch at a time, by flush, once batch labels are
+    pending or on close. Any number of processes may write to one spool,
+    each batch is written under an exclusive lock.
+
+    >>> import tempfile, shutil
+    >>> from plugin import NagiosPerformance
+    >>> tmp = tempfile.mkdtemp()
+    >>> perf = NagiosPerformance()
+    >>> perf.add_label('/var', 85.5, '%', '80', '90', 0, 100)
+    >>> perf.add_label('inodes', None)
+    >>> spool = NagiosPerfSpool(os.path.join(tmp, 'perf.bin'), batch=100)
+    >>> spool.append(perf, 'check_disk', timestamp=1000.0)
+    >>> spool.pending, spool.flush(), spool.pending
+    (2, 2, 0)
+    >>> spool.close()
+
+    >>> reader = NagiosPerfSpoolReader(spool.path)
+    >>> len(reader)
+    2
+    >>> reader[0]
+    SpoolRecord(timestamp=1000.0, service='check_disk', label='/var', value=85.5, uom='%', warn='80', crit='90', min=0.0, max=100.0)
+    >>> reader[-1].value
+    nan
+    >>> reader.close()
+
+    Labels which cannot be spooled (a newline in a string, say, or a min
+    which is not a number) are refused as they are appended, so that they
+    never hold up the labels after them
+
+    >>> spool = NagiosPerfSpool(os.path.join(tmp, 'perf.bin'), batch=100)
+    >>> bad = NagiosPerformance()
+    >>> bad.add_label('two\\nlines', 1)
+    >>> bad.add_label('load', 0.5, min='none')
+    >>> bad.add_label('users', 3)
+    >>> spool.append(bad, 'check_bad', timestamp=2000.0)
+    Traceback (most recent call last):
+    ...
+    NagiosPluginError: Could not spool 2 label(s) of check_bad: 'two\\nlines', 'load'
+    >>> spool.pending, spool.flush()
+    (1, 1)
+    >>> spool.append(perf, 'check_disk', timestamp=3000.0)
+    >>> spool.flush(), len(NagiosPerfSpoolReader(spool.path))
+    (2, 5)
+    >>> spool.close(); shutil.rmtree(tmp)
+    """
+    def __init__(self, path, batch=1024):
+        """
+        @param path:  the spool file, created if it does not exist
+        @param batch: the number of labels to buffer before writing them
+        """
+        self.path = path
+        self.batch = batch
+        self.strings = _StringTable(path + '.strings')
+        self.buffer = []
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+
+    @property
+    def pending(self):
+        """ The number of labels waiting to be written. """
+        return len(self.buffer)
+
+    def append(self, performance, service='', timestamp=None):
+        """
+        Buffers the labels of a NagiosPerformance (or any sequence of
+        NagiosPerfLabel), flushing the buffer once it is full. Labels which
+        cannot be spooled are left out, and NagiosPluginError raised once
+        the rest are buffered.
+
+        @param performance: the labels
+        @param service:     the name of the service which reported them
+        @param timestamp:   seconds since the epoch (defaults to now)
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        labels = getattr(performance, 'labels', performance)
+        append, refused = self.buffer.append, []
+        for label in labels:
+            try:
+                append(_encode(timestamp, service, label))
+            except (ValueError, TypeError):
+                refused.append(label[0])
+        if len(self.buffer) >= self.batch:
+            self.flush()
+        if refused:
+            raise NagiosPluginError('Could not spool %d label(s) of %s: %s'
+                                    % (len(refused), service,
+                                       ', '.join(map(repr, refused))))
+
+    def flush(self):
+        """
+        Writes all pending labels in one write, and fsyncs the spool. If
+        the write fails the labels stay pending, and nothing of the batch
+        is left in the spool. A batch which cannot be encoded (which
+        append should have prevented) is dropped, raising
+        NagiosPluginError, rather than failing every flush after it.
+
+        @return: int, the number of labels written
+        """
+        if not self.buffer:
+            return 0
+        buffer = self.buffer
+
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size < HEADER.size:
+                os.ftruncate(self.fd, 0)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, RECORD.size))
+                size = HEADER.size
+            else:
+                # a writer which died mid-write leaves a partial record
+                torn = (size - HEADER.size) % RECORD.size
+                if torn:
+                    size -= torn
+                    os.ftruncate(self.fd, size)
+
+            strings = []
+            for record in buffer:
+                strings.extend(record[4:])
+            try:
+                ids = iter(self.strings.intern(strings))
+                pack = RECORD.pack
+                data = ''.join([
+                    pack(timestamp, value, min, max, ids.next(), ids.next(),
+                         ids.next(), ids.next(), ids.next())
+                    for timestamp, value, min, max, service, label, uom,
+                        warn, crit in buffer
+                ])
+            except (ValueError, TypeError, struct.error, NagiosPluginError), e:
+                self.buffer = []
+                raise NagiosPluginError('Dropped %d label(s) which could not '
+                                        'be spooled: %s' % (len(buffer), e))
+            os.lseek(self.fd, size, os.SEEK_SET)
+            try:
+                written = 0
+                while written < len(data):
+                    written += os.write(self.fd, data[written:])
+                os.fsync(self.fd)
+            except (IOError, OSError):
+                # eg. ENOSPC, the whole batch is written by the next flush
+                os.ftruncate(self.fd, size)
+                raise
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+        self.buffer = []
+        return len(buffer)
+
+    def close(self):
+        """ Flushes pending labels, and closes the spool. """
+        if self.fd is not None:
+            try:
+                self.flush()
+            finally:
+                os.close(self.fd)
+                self.fd = None
+
+class NagiosPerfSpoolReader(object):
+    """
+    Reads a spool written by NagiosPerfSpool, through a read-only memory
+    map of the records present when it was opened, so that scans copy
+    nothing but the records they return. Records are indexed from 0, in the
+    order they were written.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.strings = _StringTable(path + '.strings')
+        self.fileobj = open(path, 'rb')
+        size = os.fstat(self.fileobj.fileno()).st_size
+        # after the size, as writers add strings before the records which
+        # use them -- so every record counted has its strings loaded
+        self.strings.sync()
+        self.count = max(size - HEADER.size, 0) // RECORD.size
+        if self.count:
+            self.map = mmap.mmap(self.fileobj.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            magic, record_size = HEADER.unpack_from(self.map)
+            if magic != MAGIC or record_size != RECORD.size:
+                self.close()
+                raise NagiosPluginError('%s is not a perfdata spool.' % path)
+        else:
+            self.map = None
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError('spool record out of range')
+        return self._record(i)
+
+    def _record(self, i):
+        timestamp, value, min, max, service, label, uom, warn, crit = \
+                RECORD.unpack_from(self.map, HEADER.size + i * RECORD.size)
+        strings = self.strings.strings
+        return SpoolRecord(timestamp, strings[service], strings[label],
+                           value, strings[uom], strings[warn], strings[crit],
+                           min, max)
+
+    def timestamp(self, i):
+        """ Returns the timestamp of record i, without unpacking the rest. """
+        return struct.unpack_from('<d', self.map,
+                                  HEADER.size + i * RECORD.size)[0]
+
+    def find(self, timestamp):
+        """
+        Returns the index of the first record at or after timestamp, by
+        bisection -- which relies on records being written in time order.
+        With several writers, batches may interleave by up to the time it
+        takes a writer to fill one.
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _bounds(self, start, end):
+        first = 0 if start is None else self.find(start)
+        last = self.count if end is None else self.find(end)
+        return first, last
+
+    def slice(self, start=None, end=None):
+        """
+        Yields the records with start <= timestamp < end (either may be
+        None, for no bound).
+        """
+        first, last = self._bounds(start, end)
+        record = self._record
+        for i in xrange(first, last):
+            yield record(i)
+
+    def array(self, start=None, end=None):
+        """
+        Returns the records with start <= timestamp < end as a numpy record
+        array (see DTYPE) over the memory map itself, copying nothing.
+        String fields are ids, see strings. The array is only valid until
+        the reader is closed. Requires numpy.
+        """
+        np = _numpy()
+        if np is None:
+            raise NagiosPluginError('NagiosPerfSpoolReader.array requires '
+                                    'numpy.')
+        first, last = self._bounds(start, end)
+        if last <= first:
+            return np.zeros(0, dtype=DTYPE)
+        return np.frombuffer(self.map, dtype=DTYPE, count=last - first,
+                             offset=HEADER.size + first * RECORD.size)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.fileobj.close()
+
+    __iter__ = slice
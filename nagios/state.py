@@ -0,0 +1,219 @@
+# Copyright (C) 2008-2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import time
+import mmap
+import fcntl
+import struct
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+
+from plugin import NagiosPluginError
+
+"""
+nagios/state.py Martin Walsh <sysadm@mwalsh.org>
+    A file-backed store of the last sample of each continuous counter ('c'
+    performance data), so that checks may report rates. The store is a
+    fixed size hash table of records, memory-mapped and shared by every
+    check on the host, each record locked on its own -- a check reads and
+    writes only the records it uses.
+
+    store = NagiosCounterStore('/var/lib/nagios/counters')
+    rate = store.update(('check_if', host, 'eth0_in'), octets, wrap=2**32)
+    if rate is not None:
+        self.performance.add_label('eth0_in', rate.rate, 'B')
+"""
+
+__all__ = ['NagiosCounterStore', 'CounterRate']
+
+# magic, number of slots
+HEADER = struct.Struct('<8sQ')
+MAGIC = 'NPSTATE1'
+
+# key digest (0 if the slot is free), counter value, timestamp
+RECORD = struct.Struct('<QQd8x')
+
+CounterRate = namedtuple('CounterRate', 'delta seconds rate wrapped')
+
+def _digest(key):
+    """
+    Returns a non-zero 64 bit digest of key, a string or a tuple of strings
+    such as (plugin, host, label).
+    """
+    if isinstance(key, tuple):
+        key = '\0'.join(key)
+    digest = struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+    return digest or 1
+
+class NagiosCounterStore(object):
+    """
+    The last value and timestamp of many counters, keyed by (plugin, host,
+    label) or any string. Counters are non-negative integers.
+
+    >>> import tempfile, shutil
+    >>> tmp = tempfile.mkdtemp()
+    >>> store = NagiosCounterStore(os.path.join(tmp, 'counters'), slots=16)
+    >>> key = ('check_if', 'router1', 'eth0_in')
+    >>> print store.update(key, 1000, timestamp=100.0)
+    None
+    >>> store.update(key, 3000, timestamp=110.0)
+    CounterRate(delta=2000, seconds=10.0, rate=200.0, wrapped=False)
+
+    A counter which goes backwards has wrapped if that is the shorter way
+    round (for its width), and has otherwise been reset, as has one which
+    rises faster than max_rate
+
+    >>> print store.update(key, 1000, timestamp=120.0, wrap=2**32)
+    None
+    >>> store.get(key)
+    (1000, 120.0)
+    >>> print store.update(key, 2**32 - 1000, timestamp=130.0, max_rate=1e6)
+    None
+    >>> store.update(key, 1000, timestamp=140.0, wrap=2**32)
+    CounterRate(delta=2000, seconds=10.0, rate=200.0, wrapped=True)
+    >>> store.close()
+
+    >>> open(os.path.join(tmp, 'other'), 'w').write('x' * 64)
+    >>> NagiosCounterStore(os.path.join(tmp, 'other')) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    NagiosPluginError: .../other is not a counter state store.
+    >>> shutil.rmtree(tmp)
+    """
+    # striped locks, for threads of one process (fcntl locks are per process)
+    stripes = 64
+
+    def __init__(self, path, slots=65536):
+        """
+        @param path:  the state file, created if it does not exist
+        @param slots: the capacity of a new store (existing stores keep
+                      their own), at RECORD.size bytes each
+        """
+        self.path = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        self.locks = [threading.Lock() for i in range(self.stripes)]
+
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER.size, 0)
+        try:
+            size = os.fstat(self.fd).st_size
+            if size < HEADER.size:
+                os.ftruncate(self.fd, HEADER.size + slots * RECORD.size)
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.write(self.fd, HEADER.pack(MAGIC, slots))
+                magic = MAGIC
+            else:
+                magic, slots = HEADER.unpack(os.read(self.fd, HEADER.size))
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER.size, 0)
+        # closed only once unlocked, above
+        if magic != MAGIC:
+            os.close(self.fd)
+            raise NagiosPluginError('%s is not a counter state store.' % path)
+        self.slots = slots
+        self.map = mmap.mmap(self.fd, HEADER.size + slots * RECORD.size)
+
+    @contextmanager
+    def _locked(self, slot):
+        """ Holds the lock on slot, against other threads and processes. """
+        offset = HEADER.size + slot * RECORD.size
+        lock = self.locks[slot % self.stripes]
+        lock.acquire()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, RECORD.size, offset)
+            try:
+                yield offset
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, RECORD.size, offset)
+        finally:
+            lock.release()
+
+    def _probe(self, digest):
+        """ Yields the slots to try for digest, by linear probing. """
+        first = digest % self.slots
+        for i in xrange(self.slots):
+            yield (first + i) % self.slots
+
+    def get(self, key):
+        """
+        Returns the last (value, timestamp) of the counter key, or None if
+        there is none.
+        """
+        digest = _digest(key)
+        for slot in self._probe(digest):
+            with self._locked(slot) as offset:
+                found, value, timestamp = RECORD.unpack_from(self.map, offset)
+            if found == digest:
+                return value, timestamp
+            if not found:
+                return None
+        return None
+
+    def update(self, key, value, timestamp=None, wrap=2**64, max_rate=None):
+        """
+        Records a new sample of the counter key, returning the change since
+        the previous sample as a CounterRate, or None if there was no
+        previous sample, no time has passed, or the counter was reset.
+
+        @param key:       (plugin, host, label), or a string
+        @param value:     the counter value (an int)
+        @param timestamp: seconds since the epoch (defaults to now)
+        @param wrap:      the counter modulus, eg. 2**32 for a 32 bit counter
+        @param max_rate:  the highest credible rate (per second), above which
+                          the counter is taken to have been reset (optional)
+        @return: CounterRate (delta, seconds, rate per second, and whether
+                 the counter wrapped), or None
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        value = int(value)
+        if not 0 <= value < 2**64:
+            raise NagiosPluginError('Counter values must be 64 bit unsigned.')
+
+        digest = _digest(key)
+        for slot in self._probe(digest):
+            with self._locked(slot) as offset:
+                found, last, then = RECORD.unpack_from(self.map, offset)
+                if found != digest and found:
+                    continue
+                RECORD.pack_into(self.map, offset, digest, value, timestamp)
+            break
+        else:
+            raise NagiosPluginError('Counter state store is full.')
+
+        if not found:
+            return None
+        seconds = timestamp - then
+        if seconds <= 0:
+            return None
+        wrapped = value < last
+        if wrapped:
+            delta = value + wrap - last
+            # a reset, unless wrapping is the shorter way round
+            if not 0 <= delta <= wrap // 2:
+                return None
+        else:
+            delta = value - last
+        rate = delta / seconds
+        if max_rate is not None and rate > max_rate:
+            return None
+        return CounterRate(delta, seconds, rate, wrapped)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            os.close(self.fd)
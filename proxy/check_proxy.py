@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import glob
+import json
+import time
+import socket
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+# appended, so that utils/io.py does not shadow the standard io module
+sys.path.append(os.path.join(HERE, '..', 'utils'))
+
+from plugin import NagiosArgParser, NagiosPlugin, UnhandledExceptionHandler, \
+        OK, WARN, CRIT
+from units import bytes_per_second, bits_per_second
+from proxy import quantile
+
+"""
+proxy/check_proxy.py Martin Walsh <sysadm@mwalsh.org>
+    Reports the health of proxy.py forwarders, read from their stats
+    sockets (see proxy.py --stats): active connections, the rates of new
+    connections, bytes each way and errors, and the time taken to connect
+    to the destination, as performance data -- so that a saturated proxy
+    shows before its users notice.
+
+    The stats of every socket matching -S (a glob, for the PATH.N sockets
+    of workers) are summed. Rates are measured over --interval seconds, or
+    given a --state file (see nagios/state.py), since the last check.
+    Thresholds may be given per label (active, connection_rate, up_Bps,
+    down_Bps, error_rate, and connect_p50 and connect_p99, in ms), plain 
+    thresholds apply to active.
+
+    check_proxy.py -S '/var/run/proxy.stats*' \\
+        -w active=800,connect_p99=50 -c active=1000,connect_p99=500
+"""
+
+__all__ = ['CheckProxy', 'read_stats', 'difference']
+
+# cumulative counters, reported as rates
+COUNTERS = ('connections', 'bytes_up', 'bytes_down', 'errors')
+
+def read_stats(path, deadline):
+    """ Returns the stats served on the unix socket at path, as a dict. """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        deadline.settimeout(sock)
+        sock.connect(path)
+        chunks = []
+        while True:
+            deadline.settimeout(sock)
+            data = sock.recv(65536)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        sock.close()
+    return json.loads(''.join(chunks))
+
+def _add(counts, more):
+    """ Returns the sum of two lists of histogram counts (or of one). """
+    if not counts:
+        return list(more)
+    return [a + b for a, b in zip(counts, more)]
+
+def difference(before, after):
+    """
+    Returns the change in the counters (and connect histogram counts),
+    summed over the processes found in both lists of stats (by pid), and
+    the number of active connections in after. A process which is in only
+    one list was started or stopped in between, its counters are left out.
+
+    >>> def stats(pid, connections, counts, active=0):
+    ...     return dict(pid=pid, connections=connections, bytes_up=0,
+    ...                 bytes_down=0, errors=0, active=active,
+    ...                 connect=dict(bounds=[0.001, 0.01], counts=counts))
+    >>> before = [stats(1, 10, [1, 0, 0]), stats(2, 5, [0, 1, 0])]
+    >>> after = [stats(1, 15, [3, 1, 0], 2), stats(2, 6, [0, 2, 0], 3),
+    ...          stats(3, 1, [1, 0, 0], 1)]
+    >>> total = difference(before, after)
+    >>> total['connections'], total['active'], total['connect']
+    (6, 6, ([0.001, 0.01], [2, 2, 0]))
+    """
+    total = dict((name, 0) for name in COUNTERS)
+    total['active'] = sum(stats['active'] for stats in after)
+    bounds, counts = [], []
+    earlier = dict((stats['pid'], stats) for stats in before)
+    for stats in after:
+        then = earlier.get(stats['pid'])
+        if then is None:
+            continue
+        for name in COUNTERS:
+            total[name] += stats[name] - then[name]
+        connect = stats['connect']
+        bounds = connect['bounds']
+        counts = _add(counts, [a - b for a, b in zip(
+                connect['counts'], then['connect']['counts']
+        )])
+    total['connect'] = (bounds, counts)
+    return total
+
+class CheckProxy(NagiosPlugin):
+    def sample(self):
+        """
+        Returns the stats of every socket matching the stats option, and
+        the number of sockets which did not answer.
+        """
+        found, failed = [], 0
+        for path in sorted(glob.glob(self.options.stats)):
+            try:
+                found.append(read_stats(path, self.deadline))
+            except (socket.error, ValueError):
+                # a worker which is restarting, or gone
+                failed += 1
+        return found, failed
+
+    def stored(self, after):
+        """
+        Returns the change in the counters since the last check, from the
+        state file, and the seconds since, or None on the first check.
+        """
+        from state import NagiosCounterStore
+        store = NagiosCounterStore(self.options.state)
+        try:
+            total, rates = difference([], after), []
+            for name in COUNTERS:
+                key = ('check_proxy', self.options.stats, name)
+                value = sum(stats[name] for stats in after)
+                rate = store.update(key, value)
+                rates.append(rate)
+                if rate is not None:
+                    total[name] = rate.delta
+        finally:
+            store.close()
+        if None in rates:
+            return total, None
+        # there is no state for latency, it is since the proxies started
+        bounds, counts = [], []
+        for stats in after:
+            bounds = stats['connect']['bounds']
+            counts = _add(counts, stats['connect']['counts'])
+        total['connect'] = (bounds, counts)
+        return total, max(rate.seconds for rate in rates)
+
+    @UnhandledExceptionHandler()
+    def check(self):
+        before, failed = self.sample()
+        if not before:
+            self.die(CRIT, 'No proxy answering on %s' % self.options.stats)
+
+        if self.options.state:
+            total, seconds = self.stored(before)
+        else:
+            started = time.time()
+            self.deadline.sleep(self.options.interval)
+            after, failed = self.sample()
+            total = difference(before, after)
+            seconds = time.time() - started
+
+        perf = self.performance
+        perf.add_label('active', total['active'])
+        code = self.check_thresholds(total['active'], 'active')
+        info = ['%d active' % total['active']]
+        if seconds is None:
+            info.append('rates from the next check')
+        else:
+            connections = total['connections'] / seconds
+            errors = total['errors'] / seconds
+            up = bytes_per_second(total['bytes_up'], seconds, human=False)
+            down = bytes_per_second(total['bytes_down'], seconds,
+                                    human=False)
+            bounds, counts = total['connect']
+            p50 = p99 = None
+            if bounds:
+                p50 = quantile(bounds, counts, 0.5)
+                p99 = quantile(bounds, counts, 0.99)
+            values = [('connection_rate', connections, ''),
+                      ('up_Bps', up, ''), ('down_Bps', down, ''),
+                      ('error_rate', errors, '')]
+            if p50 is not None:
+                values += [('connect_p50', p50 * 1000, 'ms'),
+                           ('connect_p99', p99 * 1000, 'ms')]
+            for label, value, uom in values:
+                perf.add_label(label, round(value, 6), uom)
+                code = max(code, self.check_thresholds(value, label))
+
+            info.append('%.1f connections/s' % connections)
+            for name, direction in (('up', 'bytes_up'),
+                                    ('down', 'bytes_down')):
+                info.append('%s %s (%s)' % (
+                        name,
+                        bytes_per_second(total[direction], seconds),
+                        bits_per_second(total[direction] * 8, seconds),
+                ))
+            if p99 is not None:
+                info.append('connect p99 %gms' % (p99 * 1000))
+            info.append('%.1f errors/s' % errors)
+
+        if failed:
+            code = max(code, WARN)
+            info.append('%d stats socket(s) not answering' % failed)
+        self.die(code, ', '.join(info))
+
+    def check_thresholds(self, value, label=None):
+        # plain thresholds are for active connections alone, the rest have
+        # only the ranges given for their labels (or '*')
+        if label == 'active':
+            return NagiosPlugin.check_thresholds(self, value, label)
+        thresholds = self.thresholds
+        critical, warning = thresholds.critical_map, thresholds.warning_map
+        if critical is not None and critical[label].check_range(value):
+            return CRIT
+        if warning is not None and warning[label].check_range(value):
+            return WARN
+        return OK
+
+if __name__ == '__main__':
+    parser = NagiosArgParser()
+    parser.add_option('-S', '--stats', dest='stats',
+                      default='/var/run/proxy.stats*',
+                      help='the stats socket(s) of the proxy, a glob '
+                           '(default: /var/run/proxy.stats*)')
+    parser.add_option('-i', '--interval', dest='interval', type='float',
+                      default=1.0, help='seconds over which to measure '
+                                        'rates (default: 1)')
+    parser.add_option('--state', dest='state', metavar='FILE',
+                      help='measure rates since the last check instead, '
+                           'keeping counters in FILE')
+
+    CheckProxy(parser, network=False).check()
@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+# Copyright (C) 2012 Martin Walsh <sysadm@mwalsh.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import sys
+import json
+import time
+import errno
+import socket
+import platform
+import multiprocessing
+import SocketServer
+from optparse import OptionParser
+
+from proxy import TCPForwarder, UDPForwarder, Supervisor, Poller, \
+        READ, WRITE, WOULDBLOCK, splice_available
+
+"""
+proxy/loadgen.py Martin Walsh <sysadm@mwalsh.org>
+    A load generator, for sizing proxy.py deployments and comparing its
+    forwarding engines on one host. It starts a local server (an echo
+    server, or a sink for streaming), runs a forwarder in front of it, and
+    drives load through the forwarder from client processes, each running
+    many connections in an event loop:
+
+      rr       each connection sends a message, waits for its echo, repeats
+      connect  as rr, with a new connection for every message
+      stream   each connection sends as fast as it can, to the sink
+
+    UDP is driven request/response only, with a datagram per message.
+    Throughput, requests and connections per second, latency quantiles
+    (p50, p99, p999) and the forwarder's CPU time are written as JSON.
+
+    loadgen.py -m rr -c 64 -s 512 -d 10 --engine splice -o splice.json
+"""
+
+__all__ = ['run', 'percentile']
+
+MODES = ('rr', 'connect', 'stream')
+ENGINES = ('copy', 'splice', 'direct')
+
+def percentile(values, q):
+    """
+    Returns the q quantile (0 to 1) of values, which are sorted, by the
+    nearest rank, or None if there are none.
+
+    >>> values = range(1, 1001)
+    >>> percentile(values, 0.5), percentile(values, 0.99), \\
+    ...     percentile(values, 0.999)
+    (500, 990, 999)
+    """
+    if not values:
+        return None
+    rank = max(int(round(q * len(values))), 1)
+    return values[rank - 1]
+
+class EchoHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        recv, send = self.request.recv, self.request.sendall
+        try:
+            while True:
+                data = recv(65536)
+                if not data:
+                    break
+                send(data)
+        except socket.error:
+            pass
+
+class SinkHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        recv = self.request.recv
+        try:
+            while recv(65536):
+                pass
+        except socket.error:
+            pass
+
+class TCPServer(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+class UDPEchoServer(SocketServer.UDPServer):
+    allow_reuse_address = True
+
+    def serve_forever(self):
+        sock = self.socket
+        while True:
+            data, address = sock.recvfrom(65535)
+            sock.sendto(data, address)
+
+def _serve(target):
+    process = multiprocessing.Process(target=target)
+    process.daemon = True
+    process.start()
+    return process
+
+def _cpu_seconds(pid):
+    """
+    Returns the user and system CPU time of process pid, and of its
+    children (the workers of a Supervisor), in seconds.
+    """
+    total = 0.0
+    pids = [pid]
+    try:
+        children = open('/proc/%d/task/%d/children' % (pid, pid)).read()
+        pids += map(int, children.split())
+    except IOError:
+        pass
+    for pid in pids:
+        try:
+            fields = open('/proc/%d/stat' % pid).read().rsplit(')', 1)[1]
+        except IOError:
+            continue
+        fields = fields.split()
+        total += (int(fields[11]) + int(fields[12])) / \
+                float(os.sysconf('SC_CLK_TCK'))
+    return total
+
+class _Connection(object):
+    __slots__ = ('sock', 'out', 'received', 'started')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.out = None       # the rest of the message to send
+        self.received = 0     # of the echo
+        self.started = 0.0    # when the message (or connection) began
+
+def _tcp_connect(address):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    err = sock.connect_ex(address)
+    if err not in (0, errno.EINPROGRESS):
+        sock.close()
+        raise socket.error(err, os.strerror(err))
+    return sock
+
+def _tcp_client(address, mode, connections, size, duration):
+    """ Drives connections, in one process, until duration has passed. """
+    message = memoryview('x' * size)
+    poller, conns = Poller(), {}
+    result = dict(latencies=[], bytes=0, requests=0, connections=0,
+                  errors=0, lost=0)
+    latencies = result['latencies']
+
+    def begin(conn, now):
+        conn.out, conn.received, conn.started = message, 0, now
+        # reading too, as a large message is echoed while it is sent
+        poller.modify(conn.sock.fileno(), READ | WRITE)
+
+    def connect(now):
+        try:
+            sock = _tcp_connect(address)
+        except socket.error:
+            result['errors'] += 1
+            return
+        conn = conns[sock.fileno()] = _Connection(sock)
+        poller.register(sock.fileno(), READ | WRITE)
+        conn.out, conn.started = message, now
+        result['connections'] += 1
+
+    def close(conn):
+        fd = conn.sock.fileno()
+        poller.unregister(fd)
+        del conns[fd]
+        conn.sock.close()
+
+    now = time.time()
+    for i in xrange(connections):
+        connect(now)
+    end = now + duration
+    buffer = bytearray(65536)
+    while conns and time.time() < end:
+        for fd, events in poller.poll(0.1):
+            conn = conns.get(fd)
+            if conn is None:
+                continue
+            sock = conn.sock
+            try:
+                if events & WRITE and conn.out:
+                    sent = sock.send(conn.out)
+                    if mode == 'stream':
+                        result['bytes'] += sent
+                        conn.out = conn.out[sent:] or message
+                    else:
+                        conn.out = conn.out[sent:]
+                        if not conn.out:
+                            poller.modify(fd, READ)
+                if events & READ:
+                    count = sock.recv_into(buffer)
+                    if not count:
+                        raise socket.error(errno.ECONNRESET, 'closed')
+                    conn.received += count
+                    if conn.received >= size:
+                        now = time.time()
+                        latencies.append(now - conn.started)
+                        result['requests'] += 1
+                        result['bytes'] += size
+                        if mode == 'connect':
+                            close(conn)
+                            connect(now)
+                        else:
+                            begin(conn, now)
+                elif not events & WRITE:
+                    raise socket.error(errno.ECONNRESET, 'error')
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK:
+                    continue
+                result['errors'] += 1
+                close(conn)
+                connect(time.time())
+    for conn in conns.values():
+        close(conn)
+    return result
+
+def _udp_client(address, mode, connections, size, duration, timeout=1.0):
+    """
+    Drives a socket per connection, request/response, until duration has
+    passed. A datagram not echoed within timeout is lost, and resent.
+    """
+    message = 'x' * size
+    poller, conns = Poller(), {}
+    result = dict(latencies=[], bytes=0, requests=0,
+                  connections=connections, errors=0, lost=0)
+    latencies = result['latencies']
+
+    def send(conn):
+        # eg. ECONNREFUSED, for an ICMP error to an earlier datagram, which
+        # is counted, as on recv, and resent once timeout has passed
+        try:
+            conn.sock.send(message)
+        except socket.error, e:
+            if e.args[0] not in WOULDBLOCK:
+                result['errors'] += 1
+
+    now = time.time()
+    for i in xrange(connections):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        sock.connect(address)
+        conn = conns[sock.fileno()] = _Connection(sock)
+        poller.register(sock.fileno(), READ)
+        conn.started = now
+        send(conn)
+    end, swept = now + duration, now
+    while time.time() < end:
+        for fd, events in poller.poll(0.1):
+            conn = conns[fd]
+            try:
+                data = conn.sock.recv(65535)
+            except socket.error, e:
+                if e.args[0] not in WOULDBLOCK:
+                    result['errors'] += 1
+                continue
+            now = time.time()
+            latencies.append(now - conn.started)
+            result['requests'] += 1
+            result['bytes'] += len(data)
+            conn.started = now
+            send(conn)
+        now = time.time()
+        if now - swept > timeout / 4:
+            swept = now
+            for conn in conns.values():
+                if now - conn.started > timeout:
+                    result['lost'] += 1
+                    conn.started = now
+                    send(conn)
+    for conn in conns.values():
+        conn.sock.close()
+    return result
+
+def _client(args):
+    protocol, address, mode, connections, size, duration = args
+    if protocol == 'udp':
+        return _udp_client(address, mode, connections, size, duration)
+    return _tcp_client(address, mode, connections, size, duration)
+
+def _forwarder(protocol, engine, destination, workers):
+    """ Starts a forwarder, returning (its address, its process). """
+    if protocol == 'udp':
+        make = lambda address, **kwargs: UDPForwarder(
+                address, destination, **kwargs)
+    else:
+        make = lambda address, **kwargs: TCPForwarder(
+                address, destination, splice=engine == 'splice', **kwargs)
+    if not workers:
+        forwarder = make(('127.0.0.1', 0))
+        return forwarder.address, _serve(forwarder.serve_forever)
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    supervisor = Supervisor(lambda: make(address, reuse_port=True), workers,
+                            drain_timeout=1)
+    return address, _serve(supervisor.serve_forever)
+
+def run(protocol='tcp', mode='rr', connections=16, size=64, duration=10.0,
+        processes=None, engine='copy', workers=0, target=None):
+    """
+    Runs a load test, returning its results as a dict.
+
+    @param protocol:    tcp or udp
+    @param mode:        one of MODES (udp is always rr)
+    @param connections: the number of concurrent connections
+    @param size:        the size of each message, in bytes
+    @param duration:    seconds of load
+    @param processes:   the client processes (defaults to the number of
+                        processors)
+    @param engine:      one of ENGINES, the forwarder to put in front of
+                        the server (direct for none)
+    @param workers:     the number of forwarder worker processes (see
+                        Supervisor, 0 for a single process)
+    @param target:      the (host, port) of a server (or proxy) to load,
+                        in place of those started here
+    """
+    if protocol == 'udp':
+        mode = 'rr'
+    processes = processes or multiprocessing.cpu_count()
+    processes = max(1, min(processes, connections))
+    started = []
+    try:
+        forwarder = None
+        if target is None:
+            if protocol == 'udp':
+                server = UDPEchoServer(('127.0.0.1', 0), None)
+            else:
+                handler = mode == 'stream' and SinkHandler or EchoHandler
+                server = TCPServer(('127.0.0.1', 0), handler)
+            started.append(_serve(server.serve_forever))
+            target = server.server_address
+            if engine != 'direct':
+                target, forwarder = _forwarder(protocol, engine, target,
+                                               workers)
+                started.append(forwarder)
+            time.sleep(0.2)
+
+        shares = [connections // processes] * processes
+        for i in xrange(connections % processes):
+            shares[i] += 1
+        cpu = forwarder and _cpu_seconds(forwarder.pid)
+        pool = multiprocessing.Pool(processes)
+        try:
+            begun = time.time()
+            results = pool.map(_client, [
+                    (protocol, target, mode, share, size, duration)
+                    for share in shares
+            ])
+            elapsed = time.time() - begun
+        finally:
+            pool.close()
+            pool.join()
+        cpu = forwarder and _cpu_seconds(forwarder.pid) - cpu
+    finally:
+        for process in started:
+            process.terminate()
+
+    latencies = sorted(sum((r['latencies'] for r in results), []))
+    total = lambda name: sum(r[name] for r in results)
+    def ms(seconds):
+        if seconds is None:
+            return None
+        return seconds * 1000
+    return dict(
+        protocol=protocol, mode=mode, engine=engine, workers=workers,
+        connections=connections, size=size, processes=processes,
+        seconds=elapsed, python=platform.python_version(),
+        throughput_mbps=total('bytes') / elapsed / 2**20,
+        requests_per_second=total('requests') / elapsed,
+        connections_per_second=total('connections') / elapsed,
+        errors=total('errors'), lost=total('lost'),
+        forwarder_cpu_seconds=cpu,
+        latency_ms=dict(
+            p50=ms(percentile(latencies, 0.5)),
+            p99=ms(percentile(latencies, 0.99)),
+            p999=ms(percentile(latencies, 0.999)),
+            max=ms(percentile(latencies, 1.0)),
+        ),
+    )
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-p', '--protocol', type='choice', choices=('tcp', 'udp'),
+        default='tcp', help='tcp or udp (default: tcp)'
+    )
+    parser.add_option(
+        '-m', '--mode', type='choice', choices=MODES, default='rr',
+        help='%s (default: rr)' % ', '.join(MODES)
+    )
+    parser.add_option(
+        '-c', '--connections', type='int', default=16,
+        help='Concurrent connections (default: 16)'
+    )
+    parser.add_option(
+        '-s', '--size', type='int', default=64,
+        help='Message size, in bytes (default: 64)'
+    )
+    parser.add_option(
+        '-d', '--duration', type='float', default=10.0,
+        help='Seconds of load (default: 10)'
+    )
+    parser.add_option(
+        '-P', '--processes', type='int', default=None,
+        help='Client processes (default: one per processor)'
+    )
+    parser.add_option(
+        '--engine', type='choice', choices=ENGINES, default='copy',
+        help='The forwarder: %s (default: copy)' % ', '.join(ENGINES)
+    )
+    parser.add_option(
+        '--workers', type='int', default=0,
+        help='Forwarder worker processes (default: 0, a single process)'
+    )
+    parser.add_option(
+        '--target', metavar='HOST:PORT',
+        help='Load an echo server (or proxy) here, starting nothing'
+    )
+    parser.add_option(
+        '-o', '--output', metavar='FILE',
+        help='Write the results (JSON) here, as well as to stdout'
+    )
+
+    opts, args = parser.parse_args()
+    if args: parser.error('invalid argument: %r' % args[0])
+    if opts.engine == 'splice' and not splice_available():
+        parser.error('splice is not available here')
+    target = None
+    if opts.target:
+        host, sep, port = opts.target.rpartition(':')
+        if not sep or not port.isdigit():
+            parser.error('invalid target: %r' % opts.target)
+        target = (host, int(port))
+
+    results = run(opts.protocol, opts.mode, opts.connections, opts.size,
+                  opts.duration, opts.processes, opts.engine, opts.workers,
+                  target)
+    output = json.dumps(results, indent=1, sort_keys=True)
+    print output
+    if opts.output:
+        fileobj = open(opts.output, 'w')
+        try:
+            fileobj.write(output + '\n')
+        finally:
+            fileobj.close()
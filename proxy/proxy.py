@@ -1,40 +1,1524 @@
 #!/usr/bin/env python
 # Copyright (C) 2012 Martin Walsh <sysadm@mwalsh.org>
-# 
+#
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation, either version 3 of the License, or
 # (at your option) any later version.
-# 
+#
 # This program is distributed in the hope that it will be useful,
 # but WITHOUT ANY WARRANTY; without even the implied warranty of
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
-# 
+#
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from SocketServer import ForkingUDPServer, ForkingTCPServer,
-        ThreadingUDPServer, ThreadingTCPServer, BaseRequestHandler
+import os
+import sys
+import json
+import stat
+import time
+import errno
+import bisect
+import fcntl
+import struct
+import hashlib
+import select
+import signal
+import socket
+import logging
+import ctypes
+import ctypes.util
 from optparse import OptionParser, OptionValueError
 
-class RequestHandler(object): pass
+"""
+proxy/proxy.py Martin Walsh <sysadm@mwalsh.org>
+    A port forwarder. Connections accepted on the source address are
+    relayed to the destination by a single thread, with non-blocking
+    sockets and epoll (or poll, where epoll is unavailable), through
+    buffers allocated up front -- so that thousands of concurrent
+    connections cost neither a process nor a thread each. Datagrams are
+    relayed likewise, with a socket to the destination per client. On 
+    Linux, TCP may instead be relayed with splice(2), through a pipe, so 
+    that payloads are never copied into the process at all. 
+
+    One process uses one core. To use more, a Supervisor runs a forwarder 
+    in each of several worker processes, each listening on the same port 
+    (with SO_REUSEPORT), so that the kernel spreads connections among them.
+
+    TCPForwarder(('', 8080), ('www.example.com', 80)).serve_forever()
+    TCPForwarder(('', 8080), [('web1', 80), ('web2', 80)], 
+                 balance=dict(policy='least-connections')).serve_forever()
+    UDPForwarder(('', 514), ('loghost', 514)).serve_forever()
+    Supervisor(lambda: TCPForwarder(('', 8080), ('www.example.com', 80), 
+                                    reuse_port=True),
+               workers=4).serve_forever()
+
+    Connections may be spread over several destinations (backends), by 
+    round robin, least connections or a consistent hash of the client 
+    address, while probes in the background take failed backends out of 
+    rotation, and put them back once they answer again (see Balancer).
+
+    Given a stats path, a forwarder serves its counters (see ProxyStats), as
+    JSON, to each connection to a unix socket there, which check_proxy.py 
+    reads. 
+"""
+
+__all__ = [
+    'TCPForwarder', 'UDPForwarder', 'UpstreamPool', 'Balancer', 'Backend',
+    'BufferPool', 'PipePool', 'Poller', 'Supervisor', 'ProxyStats',
+    'Histogram', 'splice_available', 'quantile',
+]
+
+if hasattr(select, 'epoll'):
+    READ, WRITE = select.EPOLLIN, select.EPOLLOUT
+    ERROR, HANGUP = select.EPOLLERR, select.EPOLLHUP
+else:
+    READ, WRITE = select.POLLIN, select.POLLOUT
+    ERROR, HANGUP = select.POLLERR, select.POLLHUP
+
+# errors meaning try again later, and those meaning the peer has gone
+WOULDBLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+DISCONNECTED = (errno.ECONNRESET, errno.EPIPE, errno.ENOTCONN,
+                errno.ECONNREFUSED, errno.ETIMEDOUT, errno.EHOSTUNREACH)
+
+# Linux has SO_REUSEPORT from 3.9, python 2 does not name it
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 
+                       sys.platform.startswith('linux') and 15 or None)
+
+# splice(2) flags, from fcntl.h, and F_SETPIPE_SZ
+SPLICE_F_MOVE, SPLICE_F_NONBLOCK, SPLICE_F_MORE = 1, 2, 4
+F_SETPIPE_SZ = 1031
+
+# os.splice is python 3.10 and later, so splice is called through ctypes
+_SPLICE = []
+
+def _libc_splice():
+    """ Returns libc's splice, or None where there is none. """
+    if not _SPLICE:
+        splice = None
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'), 
+                                   use_errno=True)
+                splice = libc.splice
+            except (OSError, AttributeError):
+                pass
+            else:
+                splice.restype = ctypes.c_ssize_t
+                splice.argtypes = [
+                    ctypes.c_int, ctypes.c_void_p, ctypes.c_int, 
+                    ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint,
+                ]
+        _SPLICE.append(splice)
+    return _SPLICE[0]
+
+def splice_available():
+    """ Returns True if TCPForwarder(splice=True) can splice. """
+    return _libc_splice() is not None
+
+def _splice(fd_in, fd_out, length):
+    """
+    Moves up to length bytes from fd_in to fd_out (one of which must be a
+    pipe) without blocking, returning the number moved, or raising 
+    socket.error as a socket operation would. 
+    """
+    count = _libc_splice()(fd_in, None, fd_out, None, length, 
+                           SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+    if count < 0:
+        err = ctypes.get_errno()
+        raise socket.error(err, os.strerror(err))
+    return count
+
+class Poller(object):
+    """
+    A minimal readiness notifier over epoll (edge triggering is not used),
+    or poll, keeping the registered event mask of each file descriptor so
+    that unchanged interest costs no system call. A mask of None, in
+    modify, unregisters the file descriptor until it is next given one.
+    """
+    def __init__(self):
+        self._epoll = hasattr(select, 'epoll')
+        if self._epoll:
+            self._poller = select.epoll()
+        else:
+            self._poller = select.poll()
+        self.masks = {}
+
+    def register(self, fd, mask):
+        self._poller.register(fd, mask)
+        self.masks[fd] = mask
+
+    def modify(self, fd, mask):
+        current = self.masks.get(fd)
+        if mask == current:
+            return
+        if mask is None:
+            self.unregister(fd)
+        elif current is None:
+            self.register(fd, mask)
+        else:
+            self._poller.modify(fd, mask)
+            self.masks[fd] = mask
+
+    def unregister(self, fd):
+        if self.masks.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def poll(self, timeout=None):
+        """
+        Returns a list of (fd, events), waiting up to timeout seconds, or 
+        an empty list if interrupted by a signal.
+        """
+        try:
+            if self._epoll:
+                if timeout is None: timeout = -1
+                return self._poller.poll(timeout)
+            if timeout is not None: timeout *= 1000 # poll takes milliseconds
+            return self._poller.poll(timeout)
+        except (IOError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return []
+
+def quantile(bounds, counts, q):
+    """
+    Returns an upper bound on the q quantile (0 to 1) of a histogram, the 
+    bound of the bucket it falls in (or the last bound, if above it), or 
+    None if the histogram is empty.
+
+    >>> quantile([1, 2, 5], [5, 3, 1, 1], 0.5)
+    1
+    >>> quantile([1, 2, 5], [5, 3, 1, 1], 0.99)
+    5
+    """
+    total = sum(counts)
+    if not total:
+        return None
+    wanted, seen = q * total, 0
+    for bound, count in zip(bounds, counts):
+        seen += count
+        if seen >= wanted:
+            return bound
+    return bounds[-1]
+
+class Histogram(object):
+    """
+    Counts of observations falling at or below each of bounds (and above 
+    the last), so that quantiles may be estimated from many samples, or 
+    summed across processes, without keeping the samples.
+
+    >>> h = Histogram([0.001, 0.01, 0.1])
+    >>> for value in (0.0005, 0.002, 0.003, 0.5): h.observe(value)
+    >>> h.counts, h.count
+    ([1, 2, 0, 1], 4)
+    """
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        return quantile(self.bounds, self.counts, q)
+
+    def snapshot(self):
+        return dict(bounds=self.bounds, counts=self.counts, count=self.count,
+                    sum=self.sum)
+
+class ProxyStats(object):
+    """
+    The counters of one forwarder. Only the forwarder's own thread updates 
+    them, so they are plain attributes, with no locking. 
+    """
+    # seconds, for the time taken to connect to the destination
+    connect_bounds = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.started = time.time()
+        self.connections = 0  # accepted (TCP), or flows opened (UDP)
+        self.bytes_up = 0     # from clients to the destination
+        self.bytes_down = 0   # and back
+        self.errors = 0
+        self.throttled = 0    # times accepting paused, for want of room
+        self.connect = Histogram(self.connect_bounds)
+
+    def snapshot(self, **extra):
+        """ Returns the counters, and extra, as a dict. """
+        extra.update(
+            pid=os.getpid(), uptime=time.time() - self.started,
+            connections=self.connections, bytes_up=self.bytes_up, 
+            bytes_down=self.bytes_down, errors=self.errors,
+            throttled=self.throttled, connect=self.connect.snapshot(),
+        )
+        return extra
+
+class BufferPool(object):
+    """
+    Fixed size buffers, carved out of one preallocated block, and handed
+    out as (writable) memoryviews for socket.recv_into. When the block is
+    used up, buffers are allocated one at a time, and kept for reuse. The
+    pool's owner should take no more than are available, where there is a
+    limit.
+
+    >>> pool = BufferPool(size=4, count=2, limit=4)
+    >>> a, b, c = pool.get(), pool.get(), pool.get()
+    >>> len(a), pool.free, pool.allocated, pool.available
+    (4, 0, 3, 1)
+    >>> pool.put(c); pool.free, pool.available
+    (1, 2)
+    """
+    def __init__(self, size=65536, count=1024, limit=None):
+        """
+        @param size:  the size of each buffer, in bytes
+        @param count: the number of buffers to preallocate (at most limit)
+        @param limit: the most buffers to allocate (None for no limit)
+        """
+        if limit is not None:
+            count = min(count, limit)
+        self.size = size
+        self.limit = limit
+        self.allocated = count
+        block = memoryview(bytearray(size * count))
+        self._free = [block[i * size:(i + 1) * size] for i in xrange(count)]
+
+    @property
+    def free(self):
+        return len(self._free)
+
+    @property
+    def available(self):
+        """ The number of buffers which may yet be taken. """
+        if self.limit is None:
+            return sys.maxint
+        return len(self._free) + self.limit - self.allocated
+
+    def get(self):
+        try:
+            return self._free.pop()
+        except IndexError:
+            self.allocated += 1
+            return memoryview(bytearray(self.size))
+
+    def put(self, buffer):
+        self._free.append(buffer)
+
+def _connect(destination):
+    """
+    Starts a non-blocking TCP connection to destination, returning the 
+    socket, or raising socket.error if it failed at once. 
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(0)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    err = sock.connect_ex(destination)
+    if err not in (0, errno.EINPROGRESS):
+        sock.close()
+        raise socket.error(err, errno.errorcode.get(err, err))
+    return sock
+
+def _healthy(sock):
+    """
+    Returns True if sock, an idle connection, is open and has nothing to 
+    read -- anything else (data, EOF, an error) means it cannot be reused. 
+    """
+    try:
+        sock.recv(1, socket.MSG_PEEK)
+    except socket.error, e:
+        return e.args[0] in WOULDBLOCK
+    return False
+
+class UpstreamPool(object):
+    """
+    Established connections to a destination, kept ready for new clients so
+    that they need not wait for a connection of their own. At least min_size
+    connections are kept idle (or connecting), at most max_size, and idle 
+    connections older than idle_timeout are closed (and replaced, to keep 
+    min_size) before the destination does so itself. Every connection is 
+    checked when it is taken, see _healthy. 
+
+    The pool's connecting sockets are polled by its forwarder, which passes 
+    on their events (see connected), and calls maintain periodically. 
+    """
+    def __init__(self, destination, poller, min_size=0, max_size=16, 
+                 idle_timeout=30.0):
+        """
+        @param destination:  the (host, port) to connect to
+        @param poller:       the Poller of the forwarder
+        @param min_size:     the number of connections to keep ready
+        @param max_size:     the most idle connections to keep
+        @param idle_timeout: the seconds after which an idle connection is 
+                             closed
+        """
+        self.destination = destination
+        self.poller = poller
+        self.min_size, self.max_size = min_size, max_size
+        self.idle_timeout = idle_timeout
+        # (socket, idle since), most recently used last
+        self.idle = []
+        # fd -> socket, for connections being established
+        self.connecting = {}
+        self.hits = self.misses = self.discarded = 0
+
+    def get(self):
+        """ Returns an idle, healthy, connection, or None. """
+        idle = self.idle
+        while idle:
+            sock, since = idle.pop()
+            if _healthy(sock):
+                self.hits += 1
+                return sock
+            sock.close()
+            self.discarded += 1
+        self.misses += 1
+        return None
+
+    def put(self, sock):
+        """ Returns a connection to the pool (or closes it, if full). """
+        if len(self.idle) < self.max_size:
+            self.idle.append((sock, time.time()))
+        else:
+            sock.close()
+
+    def connected(self, fd):
+        """ Handles the completion of a pool connection. """
+        sock = self.connecting.pop(fd)
+        self.poller.unregister(fd)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            logging.error('pool connect to %s:%s failed: %s' % (
+                    self.destination + (errno.errorcode.get(err, err),)
+            ))
+            sock.close()
+        else:
+            self.put(sock)
+
+    def maintain(self):
+        """ Closes expired connections, and opens any needed. """
+        expired = time.time() - self.idle_timeout
+        while self.idle and self.idle[0][1] < expired:
+            self.idle.pop(0)[0].close()
+        while len(self.idle) + len(self.connecting) < self.min_size:
+            try:
+                sock = _connect(self.destination)
+            except socket.error, e:
+                logging.error('pool connect to %s:%s failed: %s' % (
+                        self.destination + (e,)
+                ))
+                return
+            self.connecting[sock.fileno()] = sock
+            self.poller.register(sock.fileno(), WRITE)
+
+    def info(self):
+        """ Returns a dict of pool statistics. """
+        taken = self.hits + self.misses
+        return dict(
+            hits=self.hits, misses=self.misses, discarded=self.discarded,
+            idle=len(self.idle), connecting=len(self.connecting),
+            hit_rate=taken and float(self.hits) / taken or 0.0,
+        )
+
+    def close(self):
+        for sock, since in self.idle:
+            sock.close()
+        for fd, sock in self.connecting.items():
+            self.poller.unregister(fd)
+            sock.close()
+        self.idle, self.connecting = [], {}
+
+def _hash(key):
+    """ Returns a 64 bit hash of the string key, stable across processes. """
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+class Backend(object):
+    """ A destination of a Balancer, and what is known of its health. """
+    def __init__(self, address):
+        self.address = address
+        self.healthy = True
+        self.active = 0       # sessions using it now
+        self.connections = 0  # and ever
+        # consecutive successful and failed probes (or connections)
+        self.rises = self.falls = 0
+        # an UpstreamPool, if its forwarder keeps them
+        self.pool = None
+
+    def info(self):
+        """ Returns a dict of the backend's state. """
+        info = dict(address='%s:%s' % self.address, healthy=self.healthy,
+                    active=self.active, connections=self.connections)
+        if self.pool is not None:
+            info['pool'] = self.pool.info()
+        return info
+
+class Balancer(object):
+    """
+    Chooses a backend for each new connection, by policy: round-robin, 
+    least-connections (the fewest active sessions, ties taken in turn), or 
+    hash (a consistent hash of the client's address, so that a client 
+    keeps its backend, and only the clients of a backend which goes down 
+    move). Only healthy backends are chosen. 
+
+    Every probe_interval, a connection to each backend is begun, in the 
+    forwarder's event loop (see probed), so that probing never delays a 
+    client. A backend is taken out of rotation after fall consecutive 
+    failed probes (or connections for clients), and put back after rise 
+    consecutive successful probes. Without probes (probe_interval None) 
+    backends are never taken out, as nothing would put them back. 
+
+    >>> balancer = Balancer([('a', 1), ('b', 1), ('c', 1)], Poller())
+    >>> [balancer.choose(None).address[0] for i in range(4)]
+    ['a', 'b', 'c', 'a']
+    >>> balancer.backends[1].healthy = False
+    >>> [balancer.choose(None).address[0] for i in range(4)]
+    ['c', 'a', 'c', 'a']
+
+    >>> balancer = Balancer([('a', 1), ('b', 1), ('c', 1)], Poller(), 'hash')
+    >>> chosen = balancer.choose(('10.0.0.1', 40000))
+    >>> chosen is balancer.choose(('10.0.0.1', 50000))
+    True
+    """
+    policies = ('round-robin', 'least-connections', 'hash')
+    # points on the hash ring, per backend
+    replicas = 64
+
+    def __init__(self, destinations, poller, policy='round-robin', 
+                 probe_interval=5.0, probe_timeout=2.0, rise=2, fall=2):
+        """
+        @param destinations:   the (host, port) of each backend
+        @param poller:         the Poller of the forwarder
+        @param policy:         one of policies
+        @param probe_interval: the seconds between probes of each backend 
+                               (None for no probes)
+        @param probe_timeout:  the seconds after which a probe has failed
+        @param rise:           the successful probes to put a backend back
+        @param fall:           the failures to take a backend out
+        """
+        if policy not in self.policies:
+            raise ValueError('unknown balancing policy %r' % policy)
+        self.backends = [Backend(tuple(address)) for address in destinations]
+        self.poller = poller
+        self.policy = policy
+        self.choose = getattr(self, '_choose_' + policy.replace('-', '_'))
+        self.probe_interval, self.probe_timeout = probe_interval, probe_timeout
+        self.rise, self.fall = rise, fall
+        self.turn = 0
+        self.ring = sorted(
+                (_hash('%s:%s-%d' % (backend.address + (i,))), backend)
+                for backend in self.backends for i in range(self.replicas)
+        )
+        self.points = [point for point, backend in self.ring]
+        # fd -> (backend, socket, started), for probes under way
+        self.probing = {}
+        self.next_probe = 0
+
+    def _choose_round_robin(self, client):
+        backends = self.backends
+        for i in xrange(len(backends)):
+            backend = backends[(self.turn + i) % len(backends)]
+            if backend.healthy:
+                self.turn += i + 1
+                return backend
+        return None
+
+    def _choose_least_connections(self, client):
+        backends, chosen = self.backends, None
+        for i in xrange(len(backends)):
+            backend = backends[(self.turn + i) % len(backends)]
+            if backend.healthy and (chosen is None or 
+                                    backend.active < chosen.active):
+                chosen, turn = backend, i
+        if chosen is not None:
+            self.turn += turn + 1
+        return chosen
+
+    def _choose_hash(self, client):
+        ring = self.ring
+        start = bisect.bisect(self.points, _hash(client and client[0] or ''))
+        for i in xrange(len(ring)):
+            backend = ring[(start + i) % len(ring)][1]
+            if backend.healthy:
+                return backend
+        return None
+
+    def failed(self, backend):
+        """ Records a failed probe, or connection, of backend. """
+        backend.rises = 0
+        backend.falls += 1
+        if self.probe_interval is None:
+            return
+        if backend.healthy and backend.falls >= self.fall:
+            backend.healthy = False
+            logging.warning('backend %s:%s is down' % backend.address)
+
+    def succeeded(self, backend):
+        """ Records a successful probe, or connection, of backend. """
+        backend.falls = 0
+        backend.rises += 1
+        if not backend.healthy and backend.rises >= self.rise:
+            backend.healthy = True
+            logging.warning('backend %s:%s is up' % backend.address)
+
+    def probe(self):
+        """ Fails overdue probes, and begins new ones when they are due. """
+        now = time.time()
+        for fd, (backend, sock, started) in self.probing.items():
+            if now - started > self.probe_timeout:
+                self._end_probe(fd)
+                self.failed(backend)
+        if self.probe_interval is None or now < self.next_probe:
+            return
+        self.next_probe = now + self.probe_interval
+        busy = set(backend for backend, sock, started 
+                   in self.probing.itervalues())
+        for backend in self.backends:
+            if backend in busy:
+                continue
+            try:
+                sock = _connect(backend.address)
+            except socket.error:
+                self.failed(backend)
+                continue
+            self.probing[sock.fileno()] = (backend, sock, now)
+            self.poller.register(sock.fileno(), WRITE)
+
+    def probed(self, fd):
+        """ Handles the completion of a probe. """
+        backend, sock, started = self.probing[fd]
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self._end_probe(fd)
+        if err:
+            self.failed(backend)
+        else:
+            self.succeeded(backend)
+
+    def _end_probe(self, fd):
+        backend, sock, started = self.probing.pop(fd)
+        self.poller.unregister(fd)
+        sock.close()
+
+    def close(self):
+        for fd in self.probing.keys():
+            self._end_probe(fd)
+
+class PipePool(object):
+    """
+    Pipes, for splicing between sockets, kept for reuse once empty (up to 
+    count of them). Pipes are made size bytes, where the system allows. 
+    As with BufferPool, no more than are available should be taken.
+    """
+    def __init__(self, size=65536, count=1024, limit=None):
+        self.size = size
+        self.count = count
+        self.limit = limit
+        self.allocated = 0
+        self._free = []
+
+    @property
+    def free(self):
+        return len(self._free)
+
+    @property
+    def available(self):
+        if self.limit is None:
+            return sys.maxint
+        return len(self._free) + self.limit - self.allocated
+
+    def get(self):
+        """ Returns a pipe, a (read fd, write fd) pair. """
+        try:
+            return self._free.pop()
+        except IndexError:
+            pipe = os.pipe()
+            try:
+                fcntl.fcntl(pipe[1], F_SETPIPE_SZ, self.size)
+            except IOError:
+                pass # the default (64KB), larger needs privileges
+            self.allocated += 1
+            return pipe
+
+    def put(self, pipe):
+        """ Returns an empty pipe to the pool. """
+        if len(self._free) < self.count:
+            self._free.append(pipe)
+        else:
+            self.discard(pipe)
+
+    def discard(self, pipe):
+        """ Closes a pipe, which may still hold data. """
+        os.close(pipe[0]); os.close(pipe[1])
+        self.allocated -= 1
+
+class _Stream(object):
+    """
+    One direction of a forwarded connection, from src to dst, through a 
+    buffer (or a pipe, when splicing).
+    """
+    def __init__(self, src, dst, buffer):
+        self.src, self.dst = src, dst
+        self.buffer = buffer
+        # buffer[start:end] is read but not yet written (when splicing, 
+        # end - start bytes are in the pipe)
+        self.start = self.end = 0
+        self.eof = False      # src has nothing more to send
+        self.shut = False     # and dst has been told so
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    @property
+    def wants_read(self):
+        return not self.eof and self.start == self.end
+
+    @property
+    def finished(self):
+        return self.shut
+
+class _Session(object):
+    """ A client connection, and its connection to the destination. """
+    def __init__(self, client, upstream, pool):
+        self.client, self.upstream = client, upstream
+        self.connecting = True
+        # the Backend connected to, and when the connection was begun
+        self.backend = None
+        self.started = None
+        # sockets whose peer has closed, which poll reports ready until
+        # closed, so they are left out of it while there is nothing to do
+        self.hungup = set()
+        self.up = _Stream(client, upstream, pool.get())
+        self.down = _Stream(upstream, client, pool.get())
+
+    def mask(self, sock):
+        """ Returns the events of interest on sock (None for none). """
+        if sock is self.upstream and self.connecting:
+            return WRITE
+        mask = 0
+        incoming, outgoing = self.streams(sock)
+        if incoming.wants_read: mask |= READ
+        if outgoing.pending: mask |= WRITE
+        if not mask and sock in self.hungup:
+            return None
+        return mask
+
+    @property
+    def reusable(self):
+        """
+        True once the client has closed, and all it sent, and all sent to 
+        it, has been delivered, while the upstream connection is still open.
+        """
+        return (self.up.finished and not self.down.pending and 
+                not self.down.eof and not self.connecting)
+
+    def streams(self, sock):
+        """ Returns the streams (reading from, writing to) sock. """
+        if sock is self.client:
+            return self.up, self.down
+        return self.down, self.up
+
+class _Forwarder(object):
+    """
+    The event loop shared by the forwarders, which dispatch the events of 
+    each file descriptor (_dispatch), and do periodic work (_tick) at least 
+    once per poll_interval.
+    """
+    running = False
+    # when draining, the time by which to stop regardless
+    draining = None
+    listener = None
+    listener_fd = -1
+    stats_path = None
+    stats_listener = None
+    stats_fd = -1
+
+    def _listen(self, kind, address, reuse_port=False, backlog=None):
+        """ Binds (and listens, given a backlog) the listening socket. """
+        self.listener = socket.socket(socket.AF_INET, kind)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            if SO_REUSEPORT is None:
+                raise socket.error(errno.ENOPROTOOPT, 
+                                   'SO_REUSEPORT is not supported')
+            self.listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.listener.bind(address)
+        if backlog is not None:
+            self.listener.listen(backlog)
+        self.listener.setblocking(0)
+        self.address = self.listener.getsockname()
+        self.listener_fd = self.listener.fileno()
+        self.poller.register(self.listener_fd, READ)
+
+    def _serve_stats(self, path):
+        """ Listens on a unix socket at path, for stats requests. """
+        try:
+            if stat.S_ISSOCK(os.lstat(path).st_mode):
+                os.unlink(path) # left by an earlier process
+        except OSError:
+            pass
+        self.stats_listener = socket.socket(socket.AF_UNIX, 
+                                            socket.SOCK_STREAM)
+        self.stats_listener.bind(path)
+        self.stats_listener.listen(16)
+        self.stats_listener.setblocking(0)
+        self.stats_path = path
+        self.stats_fd = self.stats_listener.fileno()
+        self.poller.register(self.stats_fd, READ)
+
+    def _send_stats(self):
+        while True:
+            try:
+                client, address = self.stats_listener.accept()
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            try:
+                # a few KB, which a new unix socket always has room for
+                client.setblocking(0)
+                client.sendall(json.dumps(self.stats()))
+            except socket.error:
+                pass
+            client.close()
+
+    def _stop_stats(self):
+        if self.stats_listener is not None:
+            self.poller.unregister(self.stats_fd)
+            self.stats_listener.close()
+            try:
+                os.unlink(self.stats_path)
+            except OSError:
+                pass
+            self.stats_listener, self.stats_fd = None, -1
+
+    def stats(self):
+        """ Returns a snapshot of the forwarder's counters, as a dict. """
+        raise NotImplementedError
+
+    def _stop_listening(self):
+        if self.listener is not None:
+            self.poller.unregister(self.listener_fd)
+            self.listener.close()
+            self.listener, self.listener_fd = None, -1
+
+    @property
+    def active(self):
+        """ The number of connections which draining waits for. """
+        return 0
+
+    def serve_forever(self, poll_interval=0.5):
+        """ Forwards until shutdown is called, or draining is done. """
+        self.running = True
+        poll, dispatch = self.poller.poll, self._dispatch
+        while self.running:
+            for fd, events in poll(poll_interval):
+                if fd == self.stats_fd:
+                    self._send_stats()
+                else:
+                    dispatch(fd, events)
+            self._tick()
+            if self.draining is not None:
+                # closed here, not in drain, which may run in a signal
+                # handler while _accept is using the listener
+                self._stop_listening()
+                if not self.active or time.time() > self.draining:
+                    self.running = False
+
+    def shutdown(self):
+        """ Stops serve_forever (from another thread, or a handler). """
+        self.running = False
+
+    def drain(self, timeout=30.0):
+        """
+        Has serve_forever close the listening socket, so that new
+        connections go elsewhere (to another worker), and stop once those
+        in progress are finished, or after timeout seconds. Only sets the
+        deadline, so it is safe in a signal handler.
+        """
+        if self.draining is None:
+            self.draining = time.time() + timeout
+
+    def _dispatch(self, fd, events):
+        raise NotImplementedError
+
+    def _tick(self):
+        pass
+
+class TCPForwarder(_Forwarder):
+    """
+    Relays each connection accepted on address to destination, in a single
+    thread. Each connection holds two buffers from a shared BufferPool, one
+    per direction, and a connection reads from one side only once the other
+    has taken all it last read, so that a slow reader slows its writer
+    rather than filling memory. Half-closes are passed on, connections end
+    once both directions have.
+
+    So each connection holds at most two buffers, however slow its reader. 
+    Given max_connections, or a limit on buffers (max_buffers), accepting 
+    pauses while there is no room for another connection -- new clients 
+    wait in the listen backlog -- and resumes as connections end, bounding
+    the forwarder's memory as a whole. 
+
+    With splice (where splice_available), each direction is a pipe, from 
+    a PipePool, rather than a buffer, and data moves from socket to pipe to 
+    socket within the kernel. Otherwise, or where splice is unavailable, 
+    data is read with recv_into, into buffers from a BufferPool. 
+
+    Given several destinations, each connection goes to a backend chosen 
+    by a Balancer (configured by balance). A single destination is not 
+    probed, so is never taken out of rotation: once it answers again, 
+    clients are forwarded to it, however many failed before. 
+
+    >>> import threading
+    >>> logging.disable(logging.ERROR)
+    >>> sock = socket.socket(); sock.bind(('127.0.0.1', 0))
+    >>> destination = sock.getsockname(); sock.close()
+    >>> forwarder = TCPForwarder(('127.0.0.1', 0), destination)
+    >>> thread = threading.Thread(target=forwarder.serve_forever, 
+    ...                           args=(0.05,))
+    >>> thread.start()
+    >>> def refused():
+    ...     client = socket.create_connection(forwarder.address, 5)
+    ...     try:
+    ...         return client.recv(64)
+    ...     finally:
+    ...         client.close()
+    >>> refused(), refused(), refused() # nothing listening at destination
+    ('', '', '')
+    >>> server = socket.socket()
+    >>> server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    >>> server.bind(destination); server.listen(1); server.settimeout(5)
+    >>> client = socket.create_connection(forwarder.address, 5)
+    >>> client.sendall('ping')
+    >>> upstream = server.accept()[0]
+    >>> upstream.recv(64), forwarder.balancer.backends[0].falls
+    ('ping', 0)
+    >>> for sock in (client, upstream, server): sock.close()
+    >>> forwarder.drain(0); thread.join()
+    >>> logging.disable(logging.NOTSET)
+
+    Nor is a single destination (-d) given on the command line
+
+    >>> import shutil, tempfile, subprocess
+    >>> tmp = tempfile.mkdtemp(); stats = os.path.join(tmp, 'stats')
+    >>> server = socket.socket(); server.settimeout(1)
+    >>> server.bind(('127.0.0.1', 0)); server.listen(1)
+    >>> proxy = subprocess.Popen([
+    ...     sys.executable, os.path.splitext(__file__)[0] + '.py', 
+    ...     '-s', '127.0.0.1', '--sport', '0', '--stats', stats, 
+    ...     '-d', '%s:%d' % server.getsockname()
+    ... ])
+    >>> for i in range(100):
+    ...     if os.path.exists(stats): break
+    ...     time.sleep(0.05)
+    >>> server.accept() # a probe would connect at once
+    Traceback (most recent call last):
+    ...
+    timeout: timed out
+    >>> proxy.terminate(); proxy.wait()
+    0
+    >>> server.close(); shutil.rmtree(tmp)
+
+    Given UpstreamPools (upstreams, one per backend), clients are handed 
+    established connections where there are any. With reuse, a client's 
+    connection is returned to the pool once the client has closed, and 
+    everything sent both ways has been delivered, rather than being closed 
+    -- only for protocols where a server connection may serve one client 
+    after another (HTTP keep-alive, say), and where clients do not 
+    half-close to wait for a reply. 
+    """
+    def __init__(self, address, destination, buffer_size=65536, buffers=1024,
+                 backlog=1024, upstreams=None, reuse=False, splice=False,
+                 reuse_port=False, stats=None, balance=None, 
+                 max_connections=None, max_buffers=None):
+        """
+        @param address:     the (host, port) to listen on
+        @param destination: the (host, port) to forward connections to, or 
+                            a list of them (backends)
+        @param buffer_size: the size of each buffer (two per connection)
+        @param buffers:     the number of buffers to preallocate
+        @param backlog:     the listen backlog
+        @param upstreams:   the UpstreamPool keyword arguments (min_size, 
+                            max_size, idle_timeout) of a pool of connections
+                            to each backend (optional)
+        @param reuse:       if True, return connections to the pool after use
+        @param splice:      if True, splice rather than copy, where possible
+                            (buffer_size is then the size of each pipe, and
+                            buffers the number of free pipes to keep)
+        @param reuse_port:  if True, share address with other processes (see
+                            Supervisor)
+        @param stats:       the path of a unix socket on which to serve stats
+                            (optional)
+        @param balance:     the Balancer keyword arguments (policy, 
+                            probe_interval, probe_timeout, rise, fall), by 
+                            default round robin, probing only given several 
+                            backends
+        @param max_connections: the most connections to forward at once
+        @param max_buffers: the most buffers (or pipes) to allocate, two per
+                            connection
+        """
+        if isinstance(destination, tuple):
+            destination = [destination]
+            if balance is None:
+                balance = dict(probe_interval=None)
+        self.destination = destination
+        self.splice = splice and splice_available()
+        if self.splice:
+            self.pool = PipePool(buffer_size, buffers, max_buffers)
+        else:
+            self.pool = BufferPool(buffer_size, buffers, max_buffers)
+        self.max_connections = max_connections
+        # False while accepting is paused, for want of room
+        self.accepting = True
+        self.poller = Poller()
+        # fd -> _Session, for both sockets of each session
+        self.sessions = {}
+        self.balancer = Balancer(destination, self.poller, **(balance or {}))
+        self.pools = []
+        if upstreams is not None:
+            for backend in self.balancer.backends:
+                backend.pool = UpstreamPool(backend.address, self.poller, 
+                                            **upstreams)
+                backend.pool.maintain()
+                self.pools.append(backend.pool)
+        self.reuse = reuse and upstreams is not None
+        self.counters = ProxyStats()
+        self._listen(socket.SOCK_STREAM, address, reuse_port, backlog)
+        if stats is not None:
+            self._serve_stats(stats)
+
+    @property
+    def active(self):
+        return len(self.sessions) // 2
+
+    def _room(self):
+        """ True if there is room for another connection. """
+        if self.pool.available < 2:
+            return False
+        return self.max_connections is None or \
+                self.active < self.max_connections
+
+    def stats(self):
+        return self.counters.snapshot(
+                protocol='tcp', active=self.active, accepting=self.accepting,
+                buffers=self.pool.allocated, policy=self.balancer.policy,
+                backends=[backend.info() for backend in self.balancer.backends]
+        )
+
+    def _dispatch(self, fd, events):
+        if fd == self.listener_fd:
+            self._accept()
+            return
+        session = self.sessions.get(fd)
+        if session is not None:
+            self._handle(session, fd, events)
+        elif fd in self.balancer.probing:
+            self.balancer.probed(fd)
+        else:
+            for pool in self.pools:
+                if fd in pool.connecting:
+                    pool.connected(fd)
+                    break
+
+    def _tick(self):
+        self.balancer.probe()
+        for backend in self.balancer.backends:
+            # a pool for a backend which is down would only fail to connect
+            if backend.pool is not None and backend.healthy:
+                backend.pool.maintain()
+
+    def server_close(self):
+        """ Closes the listening socket, and every forwarded connection. """
+        for session in set(self.sessions.values()):
+            self._close(session)
+        for pool in self.pools:
+            pool.close()
+        self.balancer.close()
+        self._stop_listening()
+        self._stop_stats()
+
+    def _accept(self):
+        while True:
+            if not self._room():
+                # until a session ends, see _close
+                self.poller.modify(self.listener_fd, None)
+                self.accepting = False
+                self.counters.throttled += 1
+                return
+            try:
+                client, address = self.listener.accept()
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK or e.args[0] == errno.ECONNABORTED:
+                    return
+                raise
+            self.counters.connections += 1
+            client.setblocking(0)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            backend = self.balancer.choose(address)
+            if backend is None:
+                logging.error('no backend is up')
+                self.counters.errors += 1
+                client.close()
+                continue
+            upstream = None
+            if backend.pool is not None:
+                upstream = backend.pool.get()
+            pooled = upstream is not None
+            started = time.time()
+            if not pooled:
+                try:
+                    upstream = _connect(backend.address)
+                except socket.error, e:
+                    logging.error('connect to %s:%s failed: %s' % (
+                            backend.address + (e,)
+                    ))
+                    self.balancer.failed(backend)
+                    self.counters.errors += 1
+                    client.close()
+                    continue
+            session = _Session(client, upstream, self.pool)
+            session.connecting = not pooled
+            session.started = started
+            session.backend = backend
+            backend.active += 1
+            backend.connections += 1
+            self.sessions[client.fileno()] = session
+            self.sessions[upstream.fileno()] = session
+            self.poller.register(client.fileno(), session.mask(client))
+            self.poller.register(upstream.fileno(), session.mask(upstream))
+
+    def _handle(self, session, fd, events):
+        if fd == session.client.fileno():
+            sock = session.client
+        else:
+            sock = session.upstream
+        try:
+            if session.connecting and sock is session.upstream:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    raise socket.error(err, errno.errorcode.get(err, err))
+                session.connecting = False
+                self.balancer.succeeded(session.backend)
+                self.counters.connect.observe(time.time() - session.started)
+                # anything the client sent while we were connecting
+                self._write(session, session.up)
+            else:
+                if events & HANGUP: session.hungup.add(sock)
+                incoming, outgoing = session.streams(sock)
+                if events & (READ | HANGUP | ERROR) and incoming.wants_read:
+                    self._read(session, incoming)
+                if events & WRITE:
+                    self._write(session, outgoing)
+                if events & ERROR:
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    raise socket.error(err, errno.errorcode.get(err, err))
+        except socket.error, e:
+            if e.args[0] not in DISCONNECTED:
+                logging.error('%s:%s: %s' % (session.backend.address + (e,)))
+            if session.connecting:
+                self.balancer.failed(session.backend)
+            self.counters.errors += 1
+            self._close(session)
+            return
+
+        if session.up.finished and session.down.finished:
+            self._close(session)
+        elif self.reuse and session.reusable:
+            self._close(session, reuse=True)
+        else:
+            poller = self.poller
+            poller.modify(session.client.fileno(),
+                          session.mask(session.client))
+            poller.modify(session.upstream.fileno(),
+                          session.mask(session.upstream))
+
+    def _read(self, session, stream):
+        try:
+            if self.splice:
+                count = _splice(stream.src.fileno(), stream.buffer[1], 
+                                self.pool.size)
+            else:
+                count = stream.src.recv_into(stream.buffer)
+        except socket.error, e:
+            if e.args[0] in WOULDBLOCK:
+                return
+            raise
+        if count:
+            stream.start, stream.end = 0, count
+            if stream is session.up:
+                self.counters.bytes_up += count
+            else:
+                self.counters.bytes_down += count
+        else:
+            stream.eof = True
+        # most sockets can take it all at once, saving a trip through poll
+        self._write(session, stream)
+
+    def _write(self, session, stream):
+        if session.connecting:
+            return
+        buffer, send = stream.buffer, stream.dst.send
+        while stream.start < stream.end:
+            try:
+                if self.splice:
+                    stream.start += _splice(buffer[0], stream.dst.fileno(),
+                                            stream.end - stream.start)
+                else:
+                    stream.start += send(buffer[stream.start:stream.end])
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK:
+                    return
+                raise
+        stream.start = stream.end = 0
+        if stream.eof and not stream.shut:
+            if not (self.reuse and stream is session.up):
+                stream.dst.shutdown(socket.SHUT_WR)
+            stream.shut = True
+
+    def _close(self, session, reuse=False):
+        for sock in (session.client, session.upstream):
+            fd = sock.fileno()
+            self.sessions.pop(fd, None)
+            self.poller.unregister(fd)
+            if reuse and sock is session.upstream:
+                session.backend.pool.put(sock)
+            else:
+                sock.close()
+        session.backend.active -= 1
+        for stream in (session.up, session.down):
+            if self.splice and stream.pending:
+                self.pool.discard(stream.buffer)
+            else:
+                self.pool.put(stream.buffer)
+        if not self.accepting and self.listener is not None and self._room():
+            self.poller.modify(self.listener_fd, READ)
+            self.accepting = True
+
+class _Flow(object):
+    """ A client of a UDPForwarder, and its socket to the destination. """
+    __slots__ = ('address', 'sock', 'seen')
+
+    def __init__(self, address, sock, seen):
+        self.address, self.sock, self.seen = address, sock, seen
+
+class UDPForwarder(_Forwarder):
+    """
+    Relays datagrams received on address to destination, from a socket of 
+    its own for each client address (a flow), so that replies find their 
+    way back. Flows idle for idle_timeout seconds are closed, and at most 
+    max_flows are kept -- datagrams from further clients are dropped, as 
+    are those the kernel has no room to send, keeping memory bounded. Each 
+    wakeup relays up to batch datagrams from each ready socket. Replies 
+    are sent from the listening socket, so a drain (see drain) ends at once.
+    """
+    # the largest UDP payload
+    datagram_size = 65535
+
+    def __init__(self, address, destination, idle_timeout=60.0, 
+                 max_flows=65536, batch=64, reuse_port=False, stats=None):
+        """
+        @param address:      the (host, port) to listen on
+        @param destination:  the (host, port) to forward datagrams to
+        @param idle_timeout: seconds after which a silent flow is closed
+        @param max_flows:    the most client addresses to relay for at once
+        @param batch:        the most datagrams to relay per socket, per 
+                             wakeup
+        @param reuse_port:   if True, share address with other processes 
+                             (see Supervisor)
+        @param stats:        the path of a unix socket on which to serve 
+                             stats (optional)
+        """
+        self.destination = socket.getaddrinfo(
+                destination[0], destination[1], socket.AF_INET, 
+                socket.SOCK_DGRAM
+        )[0][4]
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.batch = batch
+        self.poller = Poller()
+        # client address -> _Flow, and upstream fd -> _Flow
+        self.flows = {}
+        self.upstreams = {}
+        self.relayed = self.dropped = 0
+        self.counters = ProxyStats()
+        # one buffer serves every datagram, each is sent as soon as read
+        self.buffer = memoryview(bytearray(self.datagram_size))
+        self.swept = time.time()
+        self._listen(socket.SOCK_DGRAM, address, reuse_port)
+        if stats is not None:
+            self._serve_stats(stats)
+
+    def stats(self):
+        return self.counters.snapshot(
+                protocol='udp', active=len(self.flows), relayed=self.relayed,
+                dropped=self.dropped
+        )
+
+    def _dispatch(self, fd, events):
+        if fd == self.listener_fd:
+            self._from_clients()
+        else:
+            flow = self.upstreams.get(fd)
+            if flow is not None:
+                self._from_upstream(flow)
+
+    def _flow(self, address, now):
+        """ Returns the flow of the client at address (None if full). """
+        flow = self.flows.get(address)
+        if flow is None:
+            if len(self.flows) >= self.max_flows:
+                return None
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            # connected, so the kernel filters out strangers' datagrams
+            sock.connect(self.destination)
+            flow = self.flows[address] = _Flow(address, sock, now)
+            self.upstreams[sock.fileno()] = flow
+            self.poller.register(sock.fileno(), READ)
+            self.counters.connections += 1
+        else:
+            flow.seen = now
+        return flow
+
+    def _from_clients(self):
+        buffer, recvfrom_into = self.buffer, self.listener.recvfrom_into
+        now = time.time()
+        for i in xrange(self.batch):
+            try:
+                count, address = recvfrom_into(buffer)
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK:
+                    return
+                raise
+            flow = self._flow(address, now)
+            if flow is None:
+                self.dropped += 1
+                continue
+            try:
+                flow.sock.send(buffer[:count])
+                self.relayed += 1
+                self.counters.bytes_up += count
+            except socket.error, e:
+                # full, or an ICMP error from an earlier datagram
+                self.dropped += 1
+
+    def _from_upstream(self, flow):
+        if self.listener is None:
+            return # drained
+        buffer, recv_into = self.buffer, flow.sock.recv_into
+        sendto, address = self.listener.sendto, flow.address
+        flow.seen = time.time()
+        for i in xrange(self.batch):
+            try:
+                count = recv_into(buffer)
+            except socket.error, e:
+                if e.args[0] in WOULDBLOCK:
+                    return
+                if e.args[0] in DISCONNECTED:
+                    # ICMP port unreachable, from the destination
+                    self.counters.errors += 1
+                    continue
+                raise
+            try:
+                sendto(buffer[:count], address)
+                self.relayed += 1
+                self.counters.bytes_down += count
+            except socket.error, e:
+                self.dropped += 1
+
+    def _tick(self):
+        """ Closes flows idle for idle_timeout, sweeping every quarter. """
+        now = time.time()
+        if now - self.swept < self.idle_timeout / 4:
+            return
+        self.swept = now
+        oldest = now - self.idle_timeout
+        for flow in [f for f in self.flows.itervalues() if f.seen < oldest]:
+            self._close(flow)
+
+    def _close(self, flow):
+        del self.flows[flow.address]
+        fd = flow.sock.fileno()
+        del self.upstreams[fd]
+        self.poller.unregister(fd)
+        flow.sock.close()
+
+    def server_close(self):
+        """ Closes the listening socket, and every flow. """
+        for flow in self.flows.values():
+            self._close(flow)
+        self._stop_listening()
+        self._stop_stats()
+
+class Supervisor(object):
+    """
+    Runs workers processes, each serving a forwarder of its own, made by 
+    factory (after the fork) with reuse_port, so that every worker listens 
+    on the same address and the kernel balances connections among them. 
+    Workers which die are restarted, after restart_delay if they died soon
+    after starting. On SIGTERM (or SIGINT), workers are told to drain (see 
+    drain), and are killed if still running after drain_timeout. 
+
+    Each worker is numbered, from 0, and a replacement takes the number of 
+    the worker it replaces; in a worker, factory may read it from worker 
+    (to give each worker a stats socket of its own, say).
+    """
+    # seconds between checks on the workers
+    interval = 0.2
+    # the number of this worker, in a worker process
+    worker = None
+
+    def __init__(self, factory, workers=None, drain_timeout=30.0, 
+                 restart_delay=1.0):
+        """
+        @param factory:       returns a forwarder (given no arguments), 
+                              whose address has a fixed port
+        @param workers:       the number of worker processes (defaults to 
+                              the number of processors)
+        @param drain_timeout: seconds for which workers may drain
+        @param restart_delay: seconds to wait before replacing a worker 
+                              which exited within this long of starting
+        """
+        self.factory = factory
+        self.workers = workers or os.sysconf('SC_NPROCESSORS_ONLN')
+        self.drain_timeout = drain_timeout
+        self.restart_delay = restart_delay
+        # pid -> (worker number, start time)
+        self.pids = {}
+        self.spawned = 0
+        # when stopping, the time by which to kill the workers
+        self.stopping = None
+        self.held = 0
+
+    @property
+    def restarts(self):
+        return max(0, self.spawned - self.workers)
+
+    def _spawn(self, worker):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = (worker, time.time())
+            self.spawned += 1
+            return
+        # the worker
+        code = 1
+        try:
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                self.pids, self.worker = {}, worker
+                code = self._work()
+            except Exception:
+                logging.exception('worker %d failed' % os.getpid())
+        finally:
+            os._exit(code)
+
+    def _work(self):
+        server = self.factory()
+        def drain(signum, frame):
+            server.drain(self.drain_timeout)
+        signal.signal(signal.SIGTERM, drain)
+        signal.signal(signal.SIGINT, drain)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return 0
+
+    def _stop(self, signum, frame):
+        if self.stopping is None:
+            # a moment longer than the workers allow themselves
+            self.stopping = time.time() + self.drain_timeout + 1
+            self._signal(signal.SIGTERM)
+
+    def _signal(self, signum):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def _reap(self):
+        """ Forgets exited workers, holding off restarts if need be. """
+        while self.pids:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                self.pids = {}
+                return
+            if not pid:
+                return
+            worker, started = self.pids.pop(pid, (None, None))
+            if worker is None or self.stopping is not None:
+                continue
+            logging.warning('worker %d (%d) exited (status %d)' % (
+                    worker, pid, status
+            ))
+            if time.time() - started < self.restart_delay:
+                self.held = time.time() + self.restart_delay
+
+    def serve_forever(self):
+        """ Runs the workers until stopped by SIGTERM or SIGINT. """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            while True:
+                self._reap()
+                if self.stopping is None:
+                    if time.time() >= self.held:
+                        running = set(w for w, t in self.pids.values())
+                        for worker in range(self.workers):
+                            if worker not in running:
+                                self._spawn(worker)
+                elif not self.pids:
+                    break
+                elif time.time() > self.stopping:
+                    self._signal(signal.SIGKILL)
+                time.sleep(self.interval)
+        finally:
+            if self.pids:
+                self._signal(signal.SIGKILL)
 
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option(
-       '-s', '--source', default='localhost', 
+       '-s', '--source', default='localhost',
        help='The source host (default: localhost)'
     )
     parser.add_option(
         '-d', '--destination',
-        help='The destination host'
+        help='The destination host, or host[:port],host[:port],... to '
+             'balance TCP connections over several'
     )
     parser.add_option(
         '--dport', '--destination-port', type='int', default=80,
-        help='The destination port (default: 80)'
+        help='The destination port, where not given (default: 80)'
+    )
+    parser.add_option(
+        '--balance', type='choice', choices=Balancer.policies,
+        default='round-robin',
+        help='How to choose among destinations: %s (default: round-robin)' % 
+             ', '.join(Balancer.policies)
+    )
+    parser.add_option(
+        '--probe-interval', type='float', default=5.0,
+        help='Seconds between health probes of each destination, given '
+             'several (default: 5)'
+    )
+    parser.add_option(
+        '--probe-timeout', type='float', default=2.0,
+        help='Seconds after which a health probe has failed (default: 2)'
     )
     parser.add_option(
-        '--sport', '--source-port', type='int', default=8080, 
+        '--sport', '--source-port', type='int', default=8080,
         help='The source port (default: 8080)'
     )
     parser.add_option(
@@ -42,12 +1526,123 @@ if __name__ == '__main__':
             choices=('tcp', 'udp'), default="tcp",
             help='Protocol option: TCP and UDP supported.'
     )
+    parser.add_option(
+        '--idle-timeout', type='float', default=60.0,
+        help='Seconds before an idle UDP flow is closed (default: 60)'
+    )
+    parser.add_option(
+        '--pool-min', type='int', default=0,
+        help='Connections to the destination to keep ready (default: 0)'
+    )
+    parser.add_option(
+        '--pool-max', type='int', default=0,
+        help='The most idle connections to the destination to keep '
+             '(default: 0, no pool)'
+    )
+    parser.add_option(
+        '--pool-idle', type='float', default=30.0,
+        help='Seconds before an idle pooled connection is closed '
+             '(default: 30)'
+    )
+    parser.add_option(
+        '--buffer-size', type='int', default=65536,
+        help='Bytes buffered per connection, each way (default: 65536)'
+    )
+    parser.add_option(
+        '--max-connections', type='int', default=None,
+        help='The most connections to forward at once, further clients '
+             'wait to be accepted (default: no limit)'
+    )
+    parser.add_option(
+        '--max-memory', type='float', default=None, metavar='MB',
+        help='The most memory to use for buffers, in MB, further clients '
+             'wait to be accepted (default: no limit)'
+    )
+    parser.add_option(
+        '--splice', action='store_true', default=False,
+        help='Relay TCP with splice(2), without copying, where available'
+    )
+    parser.add_option(
+        '--workers', type='int', default=0,
+        help='Worker processes sharing the source port (SO_REUSEPORT), '
+             'restarted if they die, drained on SIGTERM (default: 0, a '
+             'single process)'
+    )
+    parser.add_option(
+        '--drain-timeout', type='float', default=30.0,
+        help='Seconds the proxy (or each worker) may take to finish its '
+             'connections, after SIGTERM (default: 30)'
+    )
+    parser.add_option(
+        '--stats', metavar='PATH',
+        help='Serve counters on a unix socket at PATH (PATH.N for worker '
+             'N), for check_proxy.py'
+    )
+    parser.add_option(
+        '--reuse', action='store_true', default=False,
+        help='Return connections to the pool when clients close, for '
+             'protocols which allow it (eg. HTTP keep-alive)'
+    )
 
     opts, args = parser.parse_args()
     # helps detect -sport 8080 (first dash missing)
     if args: raise parser.error('invalid argument: %r' % args[0])
+    if not opts.destination: parser.error('a destination (-d) is required')
+    destinations = []
+    for item in opts.destination.split(','):
+        host, sep, port = item.strip().rpartition(':')
+        if not sep: host, port = port, opts.dport
+        try:
+            destinations.append((host, int(port)))
+        except ValueError:
+            parser.error('invalid destination: %r' % item)
+    balance = None
+    if len(destinations) > 1:
+        if opts.protocol == 'udp':
+            parser.error('UDP is forwarded to a single destination')
+        balance = dict(policy=opts.balance, 
+                       probe_interval=opts.probe_interval,
+                       probe_timeout=opts.probe_timeout)
+    if opts.workers and not opts.sport:
+        parser.error('workers need a fixed source port (--sport)')
+    if len(destinations) == 1:
+        # a single destination, which TCPForwarder does not probe
+        destinations = destinations[0]
 
+    def forwarder(reuse_port=False, stats=opts.stats):
+        if opts.protocol == 'udp':
+            return UDPForwarder(
+                    (opts.source, opts.sport), destinations,
+                    opts.idle_timeout, reuse_port=reuse_port, stats=stats
+            )
+        upstreams = None
+        if opts.pool_max or opts.pool_min:
+            upstreams = dict(min_size=opts.pool_min, 
+                             max_size=max(opts.pool_max, opts.pool_min),
+                             idle_timeout=opts.pool_idle)
+        max_buffers = None
+        if opts.max_memory is not None:
+            max_buffers = int(opts.max_memory * 2**20) // opts.buffer_size
+        return TCPForwarder(
+                (opts.source, opts.sport), destinations, upstreams=upstreams,
+                reuse=opts.reuse, splice=opts.splice, reuse_port=reuse_port, 
+                stats=stats, balance=balance, buffer_size=opts.buffer_size,
+                max_connections=opts.max_connections, max_buffers=max_buffers
+        )
 
-
-
-
+    if opts.workers:
+        def worker():
+            stats = opts.stats and '%s.%d' % (opts.stats, supervisor.worker)
+            return forwarder(reuse_port=True, stats=stats)
+        supervisor = Supervisor(worker, opts.workers, opts.drain_timeout)
+        supervisor.serve_forever()
+        sys.exit(0)
+    server = forwarder()
+    signal.signal(signal.SIGTERM, 
+                  lambda signum, frame: server.drain(opts.drain_timeout))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -12,16 +12,186 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
 import sys
+import mmap
+import stat
 import time
+import errno
 import select
 import StringIO
 
+__all__ = ['StdIn', 'StdInStream', 'StdInTimeout']
+
+# bytes read (or sliced from a mapped file) at a time
+CHUNK_SIZE = 65536
+# bytes of a regular file mapped at a time, a multiple of CHUNK_SIZE
+MAP_WINDOW = 16 * 1024 * 1024
+
+class StdInTimeout(IOError):
+    """ Raised when stdin has not been read to its end by the deadline. """
+
+class StdInStream(object):
+    """
+    Reads stdin as it arrives, in chunks or by line, so that input of any
+    size (a multi-GB dump, say) can be checked without holding it all in
+    memory. A regular file redirected to stdin is mapped (mmap) rather
+    than read, and a terminal is taken as no input at all, rather than
+    waiting on someone to type. Given a timeout, StdInTimeout is raised if
+    the input has not ended that many seconds after the stream was made.
+
+    Input is read from the file descriptor, not through the file object,
+    so nothing should read the file object first.
+
+    >>> from subprocess import Popen, PIPE, STDOUT
+    >>> p = Popen(
+    ...     ('printf "one\\\\ntwo\\\\nthree" | /usr/bin/python -c "import io; '
+    ...         'print [line for line in io.StdInStream()]"'),
+    ...         shell=True, stdout=PIPE, stderr=STDOUT
+    ... )
+    >>> p.communicate()[0]
+    "['one\\\\n', 'two\\\\n', 'three']\\n"
+
+    >>> # stdin redirected from a file
+    >>> p = Popen(
+    ...     ('/usr/bin/python -c "import io; stream = io.StdInStream(); '
+    ...         'print stream.regular, len(stream.read())" < io.py'),
+    ...         shell=True, stdout=PIPE, stderr=STDOUT
+    ... )
+    >>> p.communicate()[0] == 'True %d\\n' % len(open('io.py').read())
+    True
+
+    >>> # a writer which never finishes
+    >>> p = Popen(
+    ...     ('sleep 2 | /usr/bin/python -c "import io; '
+    ...         'io.StdInStream(timeout=0.1).read()" 2>&1 | tail -1'),
+    ...         shell=True, stdout=PIPE, stderr=STDOUT
+    ... )
+    >>> p.communicate()[0]
+    'io.StdInTimeout: [Errno 110] stdin did not end before the deadline\\n'
+    """
+    def __init__(self, fileobj=None, timeout=None, chunk_size=CHUNK_SIZE):
+        """
+        @param fileobj:    the input, sys.stdin by default
+        @param timeout:    seconds in which the input must end, or None to
+                           wait for as long as it takes
+        @param chunk_size: the most bytes returned by each chunk
+        """
+        self.fd = (fileobj or sys.stdin).fileno()
+        self.chunk_size = chunk_size
+        self.deadline = None
+        if timeout is not None:
+            self.deadline = time.time() + timeout
+        try:
+            mode = os.fstat(self.fd).st_mode
+        except OSError:
+            # stdin is closed
+            mode = None
+        self.empty = mode is None or os.isatty(self.fd)
+        self.regular = mode is not None and stat.S_ISREG(mode)
+        self.poller = select.poll()
+        if not (self.empty or self.regular):
+            self.poller.register(self.fd, select.POLLIN)
+
+    def remaining(self):
+        """ Returns the seconds left before the deadline, or None. """
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def _expired(self):
+        raise StdInTimeout(errno.ETIMEDOUT,
+                           'stdin did not end before the deadline')
+
+    def _wait(self):
+        """ Waits for input (or its end), until the deadline. """
+        while True:
+            remaining = self.remaining()
+            timeout = None
+            if remaining is not None:
+                timeout = remaining * 1000
+            try:
+                if self.poller.poll(timeout):
+                    return
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            self._expired()
+
+    def _mapped(self):
+        """
+        Yields chunks of a regular file, from its current offset, mapping
+        a window of it at a time so that only that much is resident.
+        """
+        offset = os.lseek(self.fd, 0, os.SEEK_CUR)
+        size = os.fstat(self.fd).st_size
+        # windows start on a page boundary, at or before the offset
+        base = offset - offset % mmap.ALLOCATIONGRANULARITY
+        try:
+            while base < size:
+                length = min(MAP_WINDOW, size - base)
+                mapped = mmap.mmap(self.fd, length, access=mmap.ACCESS_READ,
+                                   offset=base)
+                try:
+                    for start in xrange(offset - base, length,
+                                        self.chunk_size):
+                        if self.deadline is not None and \
+                                not self.remaining():
+                            self._expired()
+                        yield mapped[start:start + self.chunk_size]
+                finally:
+                    mapped.close()
+                base += length
+                offset = base
+        finally:
+            os.lseek(self.fd, max(offset, size), os.SEEK_SET)
+
+    def chunks(self):
+        """ Yields the input as it arrives, in chunks of up to chunk_size. """
+        if self.empty:
+            return
+        if self.regular:
+            for chunk in self._mapped():
+                yield chunk
+            return
+        while True:
+            self._wait()
+            try:
+                chunk = os.read(self.fd, self.chunk_size)
+            except OSError, e:
+                if e.errno in (errno.EINTR, errno.EAGAIN):
+                    continue
+                raise
+            if not chunk:
+                return
+            yield chunk
+
+    def __iter__(self):
+        """ Yields the input by line, each with its newline. """
+        pending = []
+        for chunk in self.chunks():
+            start, end = 0, chunk.find('\n')
+            while end >= 0:
+                pending.append(chunk[start:end + 1])
+                yield ''.join(pending)
+                pending = []
+                start, end = end + 1, chunk.find('\n', end + 1)
+            if start < len(chunk):
+                pending.append(chunk[start:])
+        if pending:
+            yield ''.join(pending)
+
+    def read(self):
+        """ Returns the rest of the input, as one string. """
+        return ''.join(self.chunks())
+
 class StdIn(StringIO.StringIO):
     """
     An input container that doesn't block if nothing is waiting on stdin.
     It behaves more or less like a StringIO object, not surprising given
-    it subclasses StringIO.StringIO.  
+    it subclasses StringIO.StringIO. All of the input is held in memory,
+    see StdInStream for input too large for that.
     
     It's hard to doctest this particular class for obvious reasons. Here is
     a contrived example, or two. 
@@ -46,15 +216,12 @@ class StdIn(StringIO.StringIO):
     'This is piped to StdIn\\n'
     
     """
-    def __init__(self):
-        time.sleep(0.01)
-        poller = select.poll()
-        poller.register(sys.stdin)
-        polled = poller.poll()
-        if any(mask & select.POLLIN for fd, mask in polled):
-            buffer = ''.join(line for line in sys.stdin)
-        else:
-            buffer = ''
+    def __init__(self, timeout=None):
+        """
+        @param timeout: seconds in which stdin must end (see StdInStream),
+                        or None to wait for as long as it takes
+        """
+        buffer = StdInStream(timeout=timeout).read()
         StringIO.StringIO.__init__(self, buffer)
 
     def __repr__(self):